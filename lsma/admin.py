@@ -1,7 +1,8 @@
 from django.contrib import admin
+from django.utils import timezone
 from treenode.admin import TreeNodeModelAdmin
 from treenode.forms import TreeNodeForm
-from .models import Book, Topic, Page, Section, Person, Graphic, Box, OcrFix, BookCheck, SectionCheck, GraphicCheck
+from .models import Book, Topic, Page, Section, Person, Graphic, Box, OcrFix, BookCheck, SectionCheck, GraphicCheck, Job
 
 @admin.register(OcrFix)
 class OcrFixAdmin(admin.ModelAdmin):
@@ -34,7 +35,7 @@ class BookAdmin(admin.ModelAdmin):
             'fields': ('has_vector_text', 'has_ligatures', 'scan_color', 'numbers_offset', 'roman_numbers_offset', 'other_languages')
         }),
         ('Other', {
-            'fields': ('slug', 'uuid', 'url', 'downloaded_at', 'hidden')
+            'fields': ('slug', 'uuid', 'url', 'downloaded_at', 'hidden', 'possible_duplicate_of')
         }),
         ('Date', {
             'fields': ('date_published', 'in_copyright', 'publishing_frequency')
@@ -49,6 +50,20 @@ class BookAdmin(admin.ModelAdmin):
     readonly_fields = ('slug', 'uuid', 'downloaded_at')
     date_hierarchy = 'date_published'
     filter_horizontal = ['contributions', 'topics']
+    actions = ['queue_reimport', 'queue_regenerate_text']
+
+    @admin.action(description='Queue reimport of changed pages')
+    def queue_reimport(self, request, queryset):
+        # imported pdfs stay in the download directory under their uuid
+        for book in queryset:
+            Job.objects.create(kind=Job.Kind.REIMPORT, arguments={'path': f'new_pdf_downloads/{book.uuid}.pdf', 'incremental': True})
+        self.message_user(request, f'queued {queryset.count()} reimports')
+
+    @admin.action(description='Queue text regeneration')
+    def queue_regenerate_text(self, request, queryset):
+        page_ids = list(Page.objects.filter(book__in=queryset).values_list('id', flat=True))
+        Job.objects.create(kind=Job.Kind.REGENERATE_TEXT, arguments={'page_ids': page_ids})
+        self.message_user(request, f'queued text regeneration for {len(page_ids)} pages')
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name in ['title_page', 'copyright_page']:
@@ -80,8 +95,8 @@ class TopicAdmin(TreeNodeModelAdmin):
 
 @admin.register(Page)
 class PageAdmin(admin.ModelAdmin):
-    fields = ('image_tag', 'thumbnail_tag', 'original_image', 'book', 'number', 'topics', 'search_text', 'text_generated_at', 'kinds', 'image_problems', 'text_rotation', 'max_word_height', 'median_word_height')
-    readonly_fields = ('image_tag', 'thumbnail_tag', 'max_word_height', 'median_word_height')
+    fields = ('image_tag', 'thumbnail_tag', 'original_image', 'book', 'number', 'pdf_page_number', 'spread_half', 'topics', 'search_text', 'text_generated_at', 'kinds', 'image_problems', 'text_rotation', 'max_word_height', 'median_word_height')
+    readonly_fields = ('image_tag', 'thumbnail_tag', 'pdf_page_number', 'spread_half', 'max_word_height', 'median_word_height')
     list_display = ['book', 'number', 'thumbnail_tag']
     list_per_page = 20
 
@@ -114,4 +129,17 @@ class BoxAdmin(admin.ModelAdmin):
     search_field = ['text', 'original_text']
     empty_value_display = "<empty>"
     list_per_page = 30
-    inlines = (BoxInline,)
\ No newline at end of file
+    inlines = (BoxInline,)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    fields = ('kind', 'arguments', 'priority', 'max_attempts', 'run_after', 'status', 'attempts', 'progress', 'worker', 'started_at', 'finished_at', 'error')
+    readonly_fields = ('status', 'attempts', 'progress', 'worker', 'started_at', 'finished_at', 'error')
+    list_display = ('id', 'kind', 'arguments', 'priority', 'status', 'progress', 'attempts', 'worker', 'modified')
+    list_filter = ['status', 'kind']
+    actions = ['requeue']
+
+    @admin.action(description='Queue again')
+    def requeue(self, request, queryset):
+        queryset.exclude(status=Job.Status.RUNNING).update(status=Job.Status.QUEUED, attempts=0, run_after=timezone.now())
@@ -0,0 +1,80 @@
+from PIL import Image
+import numpy as np
+
+from .models import Page
+from .preprocess import get_crop, otsu_threshold
+
+# stored as the ocr_version of pages that were classified instead of ocred,
+# bump it when the rules below change
+classifier_prefix = 'classifier-'
+classifier_version = f'{classifier_prefix}2'
+# pages are shrunk to this many pixels on their longest side first
+sample_size = 600
+# how much darker than the paper a pixel has to be to count as a mark. bleed
+# through from the next page stays above it, faded text doesn't
+mark_depth = 20
+
+
+def euler_number(ink: np.ndarray) -> int:
+    # 8-connected components minus holes from counts of 2x2 pixel patterns
+    # (gray's bit quads), vectorized over the whole image. for specks and
+    # short words it is the number of components, text shrunk to a sample
+    # merges into blobs full of holes and goes negative
+    padded = np.pad(ink, 1).astype(np.int8)
+    quads = padded[:-1, :-1] + padded[:-1, 1:] + padded[1:, :-1] + padded[1:, 1:]
+    one = np.count_nonzero(quads == 1)
+    three = np.count_nonzero(quads == 3)
+    diagonal = np.count_nonzero(
+        (quads == 2) & (padded[:-1, :-1] == padded[1:, 1:]))
+    return (one - three - 2 * diagonal) // 4
+
+def get_page_stats(image: Image.Image) -> dict:
+    image = image.convert('L')
+    image.thumbnail((sample_size, sample_size))
+    gray = np.asarray(image)
+    threshold = otsu_threshold(gray)
+    ink = gray <= threshold
+    # ignore the margins and scanner borders
+    left, top, right, bottom = get_crop(ink, padding=0)
+    if right - left < 10 or bottom - top < 10:
+        left, top, right, bottom = 0, 0, gray.shape[1], gray.shape[0]
+    crop_fraction = (right - left) * (bottom - top) / gray.size
+    gray, ink = gray[top:bottom, left:right], ink[top:bottom, left:right]
+    paper = gray[~ink]
+    marks = gray.astype(np.int16) < np.median(gray) - mark_depth if gray.size else ink
+    return {
+        'coverage': float(ink.mean()),
+        # how much darker the ink is than the paper. bleed through and dust
+        # on an empty page are barely darker
+        'contrast': float(paper.mean() - gray[ink].mean()) if ink.any() and paper.size else 0.0,
+        'components': int(euler_number(ink)),
+        # the same for what stands out from the paper whatever otsu made of it
+        'mark_coverage': float(marks.mean()),
+        'marks': int(euler_number(marks)),
+        # how much of the page the ink is spread over
+        'crop_fraction': crop_fraction,
+        'empty_rows': float((ink.mean(axis=1) < 0.01).mean()),
+        'empty_columns': float((ink.mean(axis=0) < 0.01).mean()),
+    }
+
+def classify_page(image: Image.Image) -> str | None:
+    # Page.Kind.BLANK or DECORATIVE_PAPER for pages without text worth
+    # running tesseract on, None for everything else. it errs towards None,
+    # a missed blank page only costs an ocr run
+    stats = get_page_stats(image)
+    # otsu splits even an empty page into paper and "ink", on an empty page
+    # the two are nearly the same shade. so is faded text, but that still
+    # leaves plenty of marks that are clearly darker than the paper
+    if stats['contrast'] < 40 and stats['marks'] <= 2 and stats['mark_coverage'] < 0.001:
+        return Page.Kind.BLANK
+    # a speck or two of dust, a single short caption is already more than this
+    if stats['components'] <= 2 and stats['coverage'] < 0.001:
+        return Page.Kind.BLANK
+    # marbled and patterned endpapers cover the page edge to edge, text and
+    # plates leave margins and gaps between lines or around captions. otsu
+    # spreads "ink" edge to edge on plain low contrast paper too, the
+    # pattern has to stand out from the paper
+    if (stats['coverage'] > 0.25 and stats['mark_coverage'] > 0.1 and stats['crop_fraction'] > 0.9
+            and stats['empty_rows'] < 0.02 and stats['empty_columns'] < 0.02):
+        return Page.Kind.DECORATIVE_PAPER
+    return None
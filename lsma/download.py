@@ -0,0 +1,88 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import Counter, defaultdict, deque
+from pathlib import Path
+from urllib.parse import urlsplit
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def make_session(pool_size=10) -> requests.Session:
+    # one session for every download so connections to the same host are kept alive
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def should_retry(error) -> bool:
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500 or error.response.status_code == 429)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, IncompleteDownload))
+
+def download_url(url: str, new_name: Path, session=None, retries=5, timeout=60) -> None:
+    # the file is written to new_name.part and only renamed once it is
+    # complete. after a failed transfer the next attempt asks for the rest of
+    # the file with a Range request instead of starting over
+    session = session or make_session(1)
+    part_name = Path(f'{new_name}.part')
+    for attempt in range(retries + 1):
+        start = part_name.stat().st_size if part_name.exists() else 0
+        headers = {'Range': f'bytes={start}-'} if start else {}
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+                if start and r.status_code == 416:
+                    # nothing left to download, the last attempt got everything
+                    break
+                r.raise_for_status()
+                resumed = r.status_code == 206
+                expected = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                written = 0
+                with open(part_name, 'ab' if resumed else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size = 16*1024):
+                        f.write(chunk)
+                        written += len(chunk)
+                if expected is not None and written < expected:
+                    raise IncompleteDownload(f'got {written} of {expected} bytes')
+            break
+        except Exception as e:
+            if attempt == retries or not should_retry(e):
+                raise
+            print(f'retrying {url} after {type(e).__name__}: {e}')
+            time.sleep(min(2 ** attempt, 60))
+    os.replace(part_name, new_name)
+
+def download_urls(downloads, workers=8, per_host=2, retries=5):
+    # downloads (url, path) pairs at the same time over a shared connection
+    # pool. a host never has more than per_host transfers running, and the
+    # other workers keep going on other hosts, so one slow mirror can't hold
+    # up the batch. yields (url, path, error) as each download finishes,
+    # error is None on success
+    if workers < 1 or per_host < 1:
+        raise ValueError('workers and per_host have to be at least 1')
+    session = make_session(workers)
+    waiting = defaultdict(deque)
+    for url, path in downloads:
+        waiting[urlsplit(url).netloc].append((url, path))
+    running = {}
+    per_host_running = Counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while running or any(waiting.values()):
+            for host, host_waiting in waiting.items():
+                while host_waiting and per_host_running[host] < per_host and len(running) < workers:
+                    url, path = host_waiting.popleft()
+                    future = executor.submit(download_url, url, path, session=session, retries=retries)
+                    running[future] = (url, path, host)
+                    per_host_running[host] += 1
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, path, host = running.pop(future)
+                per_host_running[host] -= 1
+                yield url, path, future.exception()
@@ -0,0 +1,190 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.db import connections
+from pathlib import Path
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .models import Book
+from .pdf import ImportInProgress, get_metadata, get_sidecar_path, import_book
+
+manifest_name = 'manifest.json'
+
+
+def get_stat(pdf_path: Path) -> dict:
+    # a new sidecar changes the metadata without touching the pdf itself
+    stat = pdf_path.stat()
+    sidecar_path = get_sidecar_path(pdf_path)
+    sidecar_mtime = sidecar_path.stat().st_mtime if sidecar_path.exists() else None
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sidecar_mtime': sidecar_mtime}
+
+def read_entry(pdf_path: Path) -> dict:
+    entry = get_stat(pdf_path)
+    try:
+        uuid, url, downloaded_at = get_metadata(pdf_path)
+    except Exception as e:
+        return {**entry, 'uuid': None, 'url': None, 'downloaded_at': None, 'error': f'{type(e).__name__}: {e}'}
+    return {
+        **entry,
+        'uuid': str(uuid) if uuid else None,
+        'url': url,
+        'downloaded_at': str(downloaded_at) if downloaded_at else None,
+        'error': None,
+    }
+
+def load_manifest(folder: Path) -> dict:
+    try:
+        return json.loads((folder / manifest_name).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_manifest(folder: Path, manifest: dict) -> None:
+    temp_path = folder / f'{manifest_name}.tmp'
+    temp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(temp_path, folder / manifest_name)
+
+def scan_inbox(folder='new_pdf_downloads', workers=8) -> dict:
+    # returns {pdf name: entry} for every pdf in folder. only files whose
+    # size or mtime changed since the last scan have their metadata read,
+    # and those are read in parallel. the result is cached in manifest.json
+    folder = Path(folder)
+    old_manifest = load_manifest(folder)
+    manifest = {}
+    to_read = []
+    for pdf_path in sorted(folder.glob('*.pdf')):
+        entry = old_manifest.get(pdf_path.name)
+        if entry and all(entry.get(key) == value for key, value in get_stat(pdf_path).items()):
+            manifest[pdf_path.name] = entry
+        else:
+            to_read.append(pdf_path)
+    if to_read:
+        print(f'reading metadata of {len(to_read)} files in {folder}')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            for pdf_path, entry in zip(to_read, executor.map(read_entry, to_read, chunksize=16)):
+                manifest[pdf_path.name] = entry
+    if manifest != old_manifest:
+        save_manifest(folder, manifest)
+    return manifest
+
+def get_import_status(manifest: dict) -> dict:
+    # {pdf name: 'imported', 'unfinished', 'new' or 'no uuid'}
+    uuids = {entry['uuid'] for entry in manifest.values() if entry['uuid']}
+    books = dict(Book.objects.filter(uuid__in=uuids).values_list('uuid', 'imported_at'))
+    books = {str(uuid): imported_at for uuid, imported_at in books.items()}
+    status = {}
+    for name, entry in manifest.items():
+        if not entry['uuid']:
+            status[name] = 'no uuid'
+        elif entry['uuid'] not in books:
+            status[name] = 'new'
+        elif books[entry['uuid']] is None:
+            status[name] = 'unfinished'
+        else:
+            status[name] = 'imported'
+    return status
+
+# connections a forked import worker inherited from the watcher. they are kept
+# referenced so they are never closed from the worker, which would close them
+# for the watcher as well
+inherited_connections = []
+
+def init_import_worker():
+    for connection in connections.all():
+        inherited_connections.append(connection.connection)
+        connection.connection = None
+    # ctrl-c is for the watcher, it lets running imports finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def wait_for_changes(inotify, timeout, stop):
+    if inotify:
+        inotify.read(timeout=int(timeout * 1000))
+    else:
+        stop.wait(timeout)
+
+def watch_inbox(folder='new_pdf_downloads', workers=2, ocr_workers=1, poll_interval=5, settle=30):
+    # imports every pdf that shows up in folder. a pdf is picked up once it
+    # has a uuid and neither it nor its sidecar changed for settle seconds.
+    # imports are resumable, so anything cut off by a crash or restart is
+    # carried on from its last committed page the next time around.
+    # SIGINT or SIGTERM stop new imports and wait for the running ones
+    folder = Path(folder)
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('stopping after the running imports finish')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    inotify = None
+    if INotify:
+        inotify = INotify()
+        inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+    else:
+        print(f'inotify_simple is not installed, polling {folder} every {poll_interval}s')
+
+    def make_executor():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=init_import_worker)
+
+    executor = make_executor()
+    running = {}
+    failed = {}
+    manifest = {}
+    try:
+        while not stop.is_set():
+            broken = False
+            for future in [future for future in running if future.done()]:
+                name = running.pop(future)
+                try:
+                    pdf_path, error = future.result()
+                except BrokenProcessPool as e:
+                    # a worker died (e.g. the oom killer), the import resumes next time around
+                    print(f'import of {folder / name} was cut off: {type(e).__name__}: {e}')
+                    broken = True
+                    continue
+                if error and error.startswith(ImportInProgress.__name__):
+                    # run_jobs or import_file has it, it is picked up again if that doesn't finish
+                    print(f'{pdf_path} is being imported elsewhere')
+                elif error:
+                    print(f'failed to import {pdf_path}: {error}')
+                    entry = manifest.get(name, {})
+                    # not tried again until the file changes
+                    failed[name] = (entry.get('size'), entry.get('mtime'))
+                else:
+                    print(f'imported {pdf_path}')
+            if broken:
+                executor.shutdown(wait=False)
+                executor = make_executor()
+
+            manifest = scan_inbox(folder)
+            now = time.time()
+            for name, file_status in get_import_status(manifest).items():
+                if len(running) >= workers:
+                    break
+                entry = manifest[name]
+                if file_status not in ('new', 'unfinished') or name in running.values():
+                    continue
+                if now - max(entry['mtime'], entry['sidecar_mtime'] or 0) < settle:
+                    continue
+                if failed.get(name) == (entry['size'], entry['mtime']):
+                    continue
+                print(f'importing {folder / name}')
+                running[executor.submit(import_book, str(folder / name), ocr_workers, True)] = name
+
+            wait_for_changes(inotify, poll_interval, stop)
+    finally:
+        if running:
+            print(f'waiting for {len(running)} imports to finish')
+        executor.shutdown(wait=True)
+        if inotify:
+            inotify.close()
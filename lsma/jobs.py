@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from functools import partial
+import os
+import signal
+import socket
+import threading
+import traceback
+
+from .models import Job, Page
+from .pdf import ImportInProgress, add_book, reimport_book, update_book
+from .regenerate import get_stale_pages, regenerate_text
+
+# progress is written over a connection of its own, most handlers run inside
+# a transaction and nothing they write is visible until it commits
+progress_connection = None
+# how long an import waits for another import of the same book
+import_in_progress_delay = timedelta(minutes=5)
+
+
+def enqueue(kind, priority=0, max_attempts=3, **arguments) -> Job:
+    # arguments are passed to the job's handler as keyword arguments, so they
+    # have to be json
+    return Job.objects.create(kind=kind, arguments=arguments, priority=priority, max_attempts=max_attempts)
+
+def get_worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def claim_job(worker_name, kinds=None) -> Job | None:
+    # the row lock is only held while the job is marked as running, SKIP
+    # LOCKED lets every other worker claim a different job at the same time
+    with transaction.atomic():
+        jobs = Job.objects.select_for_update(skip_locked=True).filter(
+            status=Job.Status.QUEUED, run_after__lte=timezone.now())
+        if kinds:
+            jobs = jobs.filter(kind__in=kinds)
+        job = jobs.order_by('-priority', 'run_after', 'id').first()
+        if job is None:
+            return None
+        job.status = Job.Status.RUNNING
+        job.attempts += 1
+        job.progress = 0
+        job.worker = worker_name
+        job.started_at = timezone.now()
+        job.finished_at = None
+        job.save()
+    return job
+
+def requeue_stale_jobs(stale_after=timedelta(hours=1)) -> int:
+    # a running job is touched every time it reports progress. one that went
+    # quiet belongs to a worker that died, it goes back in the queue unless
+    # it has used up its attempts
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.Status.RUNNING, modified__lt=now - stale_after)
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.Status.FAILED, error='the worker stopped responding', finished_at=now, modified=now)
+    return stale.update(status=Job.Status.QUEUED, modified=now)
+
+def retry_delay(attempts) -> timedelta:
+    return timedelta(minutes=min(2 ** (attempts - 1), 60))
+
+def report_progress(job, fraction):
+    global progress_connection
+    job.progress = fraction
+    if progress_connection is None:
+        progress_connection = connections.create_connection('default')
+    table = progress_connection.ops.quote_name(Job._meta.db_table)
+    with progress_connection.cursor() as cursor:
+        cursor.execute(f'UPDATE {table} SET progress = %s, modified = %s WHERE id = %s', [fraction, timezone.now(), job.pk])
+
+def run_import(job, path, ocr_workers=1):
+    add_book(path, ocr_workers=ocr_workers, resumable=True, progress=lambda fraction: report_progress(job, fraction))
+
+def run_reimport(job, path, incremental=False, ocr_workers=1):
+    progress = lambda fraction: report_progress(job, fraction)
+    if incremental:
+        update_book(path, ocr_workers=ocr_workers, progress=progress)
+    else:
+        reimport_book(path, ocr_workers=ocr_workers, progress=progress)
+
+def run_regenerate_text(job, page_ids=None, workers=1, stale_only=False, since=None):
+    # since is an iso format datetime
+    if page_ids is not None:
+        pages = Page.objects.filter(id__in=page_ids)
+    elif stale_only:
+        pages = get_stale_pages(datetime.fromisoformat(since) if since else None)
+    else:
+        pages = None
+    regenerate_text(pages, workers, progress=partial(report_progress, job))
+
+handlers = {
+    Job.Kind.IMPORT: run_import,
+    Job.Kind.REIMPORT: run_reimport,
+    Job.Kind.REGENERATE_TEXT: run_regenerate_text,
+}
+
+def run_job(job):
+    print(f'running job {job.id}: {job}')
+    try:
+        handlers[job.kind](job, **job.arguments)
+    except ImportInProgress as e:
+        # another worker or import_file has the book. that isn't a failure
+        # of this job, it waits without using up an attempt
+        job.error = f'{type(e).__name__}: {e}'
+        job.attempts -= 1
+        job.status = Job.Status.QUEUED
+        job.run_after = timezone.now() + import_in_progress_delay
+        print(f'job {job.id} waits for another import of the book, retrying after {job.run_after}')
+    except Exception as e:
+        job.error = traceback.format_exc()
+        # duplicates, books already in the db and the like fail the same way every time
+        if job.attempts < job.max_attempts and not isinstance(e, ValueError):
+            job.status = Job.Status.QUEUED
+            job.run_after = timezone.now() + retry_delay(job.attempts)
+            print(f'job {job.id} failed, retrying after {job.run_after}\n{job.error}')
+        else:
+            job.status = Job.Status.FAILED
+            print(f'job {job.id} failed for good\n{job.error}')
+    else:
+        job.status = Job.Status.DONE
+        job.progress = 1
+        job.error = ''
+        print(f'job {job.id} done')
+    finally:
+        # a failed import can leave the connection in a broken transaction
+        connections.close_all()
+    job.finished_at = timezone.now()
+    job.save()
+
+def work(kinds=None, poll_interval=5, once=False, stale_after=timedelta(hours=1)):
+    # runs queued jobs until stopped. any number of these can run against the
+    # same db, on one machine or many. SIGINT or SIGTERM let the running job
+    # finish first. with once it stops as soon as the queue is empty
+    worker_name = get_worker_name()
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('stopping after the running job finishes')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    print(f'worker {worker_name} waiting for jobs')
+    while not stop.is_set():
+        if requeued := requeue_stale_jobs(stale_after):
+            print(f'requeued {requeued} stale jobs')
+        job = claim_job(worker_name, kinds)
+        if job:
+            run_job(job)
+            continue
+        if once:
+            break
+        stop.wait(poll_interval)
@@ -0,0 +1,128 @@
+from contextlib import nullcontext
+from django.db import connection, transaction
+from django.utils import timezone
+import io
+
+from .models import Page, Box
+
+columns = [
+    'id',
+    'created',
+    'modified',
+    'page',
+    'parent',
+    'order',
+    'level',
+    'page_number',
+    'block_number',
+    'paragraph_number',
+    'line_number',
+    'word_number',
+    'left',
+    'top',
+    'width',
+    'height',
+    'original_confidence',
+    'text',
+    'original_text',
+    'empty',
+]
+
+def copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r'))
+
+def reserve_ids(count: int) -> list[int]:
+    table = Box._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+            [table, Box._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PageLoader:
+    # collects several pages and writes them together with their boxes in one
+    # transaction, the boxes with one COPY. box ids come straight from the box
+    # sequence, so parents can be filled in here instead of waiting for each
+    # level to be inserted. every flush is a checkpoint: a page is either in
+    # the db with all of its boxes or not at all
+    updated_fields = ['original_image', 'width', 'height', 'search_text', 'text_generated_at', 'image_hash', 'ocr_version', 'kinds',
+                      'text_rotation', 'image_problems', 'pdf_page_number', 'spread_half']
+
+    def __init__(self, pages_per_copy=20, metrics=None):
+        self.pages_per_copy = pages_per_copy
+        self.metrics = metrics
+        self.pending = []
+
+    def add(self, page, records, keep_open=False):
+        # keep_open holds the flush back until the next page is added
+        self.pending.append((page, records))
+        if not keep_open and len(self.pending) >= self.pages_per_copy:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # the text and the boxes it was made from get the same time, so the
+        # page doesn't look stale to regenerate_text
+        now = timezone.now()
+        for page, _ in self.pending:
+            page.text_generated_at = now
+        new_pages = [page for page, _ in self.pending if page.pk is None]
+        updated_pages = [page for page, _ in self.pending if page.pk is not None]
+        with (self.metrics.stage('insert') if self.metrics else nullcontext()), transaction.atomic():
+            Page.objects.bulk_create(new_pages)
+            if updated_pages:
+                # pages that already exist get all of their boxes replaced
+                Box.objects.filter(page__in=updated_pages).delete()
+                Page.objects.bulk_update(updated_pages, self.updated_fields)
+            self.copy_boxes(now)
+        self.pending = []
+
+    def copy_boxes(self, now):
+        count = sum(len(records) for _, records in self.pending)
+        ids = iter(reserve_ids(count))
+        buffer = io.StringIO()
+        for page, records in self.pending:
+            # tesseract lists boxes depth first, so the parent of a box is the
+            # last box seen one level up
+            last_at_level = {}
+            for order, record in enumerate(records, start=1):
+                box_id = next(ids)
+                last_at_level[record.level] = box_id
+                row = [
+                    box_id,
+                    now,
+                    now,
+                    page.id,
+                    last_at_level.get(record.level - 1),
+                    order,
+                    record.level,
+                    record.page_number,
+                    record.block_number,
+                    record.paragraph_number,
+                    record.line_number,
+                    record.word_number,
+                    record.left,
+                    record.top,
+                    record.width,
+                    record.height,
+                    record.confidence,
+                    record.text,
+                    record.text,
+                    False,
+                ]
+                buffer.write('\t'.join(copy_value(value) for value in row))
+                buffer.write('\n')
+        buffer.seek(0)
+        quoted_columns = ', '.join(connection.ops.quote_name(Box._meta.get_field(name).column) for name in columns)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY {connection.ops.quote_name(Box._meta.db_table)} ({quoted_columns}) FROM STDIN', buffer)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from lsma.models import Box
+from lsma.ocr import engines, ocr_pool, get_boxes, tesserocr
+from PIL import Image
+from functools import partial
+import time
+
+class Command(BaseCommand):
+    help = 'Compare ocr engines on a set of page images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='+', type=str, help='page image paths')
+        parser.add_argument('--workers', type=int, default=1, help='number of ocr processes')
+        # tesserocr needs libtesseract to build, leave it out where it isn't installed
+        available = [name for name in engines if name != 'tesserocr' or tesserocr]
+        parser.add_argument('--engines', nargs='+', choices=list(engines), default=available, help='engines to compare')
+
+    def handle(self, *args, **options):
+        if 'tesserocr' in options['engines'] and not tesserocr:
+            raise CommandError('tesserocr is not installed')
+        images = [Image.open(path) for path in options['images']]
+        for image in images:
+            image.load()
+        # the cache would turn every run after the first into a lookup
+        recognize = partial(get_boxes, use_cache=False)
+        results = {}
+        for name in options['engines']:
+            with ocr_pool(options['workers'], name) as executor:
+                # the first page only warms the workers up, it isn't timed
+                list(executor.map(recognize, images[:1]))
+                start = time.perf_counter()
+                all_records = list(executor.map(recognize, images))
+                elapsed = time.perf_counter() - start
+            words = sum(1 for records in all_records for record in records if record.level == Box.Level.WORD)
+            results[name] = elapsed
+            self.stdout.write(f'{name}: {len(images)} pages in {elapsed:.2f}s, {len(images)/elapsed:.2f} pages/s, {words} words')
+        if len(results) > 1:
+            fastest = min(results, key=results.get)
+            for name, elapsed in results.items():
+                if name != fastest:
+                    self.stdout.write(f'{fastest} is {elapsed/results[fastest]:.2f}x faster than {name}')
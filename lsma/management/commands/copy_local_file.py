@@ -1,5 +1,5 @@
 from django.core.management.base import BaseCommand, CommandError
-from lsma.pdf import add_book, add_metadata, download_url
+from lsma.pdf import add_book, add_metadata, find_duplicates, get_page_hashes
 from pathlib import Path
 from uuid import uuid4
 import shutil
@@ -9,6 +9,7 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('files', nargs='+', type=str, help='urls that end in .pdf')
+        parser.add_argument('--embed-metadata', action='store_true', help='write the metadata into the pdf instead of a sidecar file')
 
     def handle(self, *args, **options):
         pdf_dir = Path('new_pdf_downloads')
@@ -17,9 +18,13 @@ class Command(BaseCommand):
             f = Path(f)
             if f.suffix not in ['.pdf', '.PDF']:
                 raise ValueError('file is not a pdf file')
+            duplicate, _ = find_duplicates(get_page_hashes(f))
+            if duplicate:
+                self.stdout.write(f'skipping {f}, it is already in the db as {duplicate.uuid}')
+                continue
             self.stdout.write(f'copying {f}')
             uuid = uuid4()
             pdf_path = pdf_dir / (str(uuid) + '.pdf')
             shutil.copy(f, pdf_path)
-            add_metadata(pdf_path, '', uuid)
+            add_metadata(pdf_path, '', uuid, sidecar=not options['embed_metadata'])
             self.stdout.write(f'{f} copied')
\ No newline at end of file
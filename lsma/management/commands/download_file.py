@@ -1,21 +1,47 @@
 from django.core.management.base import BaseCommand, CommandError
-from lsma.pdf import add_book, add_metadata, download_url
+from lsma.download import download_urls
+from lsma.pdf import add_book, add_metadata, find_duplicates, get_page_hashes
 from pathlib import Path
-from uuid import uuid4
+from uuid import NAMESPACE_URL, uuid4, uuid5
+import os
 
 class Command(BaseCommand):
     help = 'Import urls to pdf directory and import to database'
 
     def add_arguments(self, parser):
         parser.add_argument('urls', nargs='+', type=str, help='urls that end in .pdf')
+        parser.add_argument('--workers', type=int, default=8, help='number of downloads to run at the same time')
+        parser.add_argument('--per-host', type=int, default=2, help='maximum number of downloads from one host at a time')
+        parser.add_argument('--retries', type=int, default=5, help='number of times to resume a failed download')
+        parser.add_argument('--embed-metadata', action='store_true', help='write the metadata into the pdf instead of a sidecar file')
 
     def handle(self, *args, **options):
+        if options['workers'] < 1 or options['per_host'] < 1:
+            raise CommandError('--workers and --per-host have to be at least 1')
         pdf_dir = Path('new_pdf_downloads')
-        urls = options['urls']
-        for url in urls:
-            self.stdout.write(f'downloading {url}')
+        # downloads are named after their url until they are complete, so the
+        # .part a failed run leaves behind is picked up by the next run
+        downloads = [(url, pdf_dir / f'{uuid5(NAMESPACE_URL, url)}.download') for url in dict.fromkeys(options['urls'])]
+        self.stdout.write(f'downloading {len(downloads)} urls')
+        failures = []
+        for url, download_path, error in download_urls(downloads, options['workers'], options['per_host'], options['retries']):
+            if error:
+                self.stderr.write(f'failed to download {url}: {error}')
+                failures.append(url)
+                continue
+            duplicate, _ = find_duplicates(get_page_hashes(download_path))
+            if duplicate:
+                self.stdout.write(f'{url} is already in the db as {duplicate.uuid}, removing the download')
+                download_path.unlink()
+                continue
             uuid = uuid4()
-            pdf_path = pdf_dir / (str(uuid) + '.pdf')
-            download_url(url, pdf_path)
-            add_metadata(pdf_path, url, uuid)
-            self.stdout.write(f'{url} downloaded')
\ No newline at end of file
+            pdf_path = pdf_dir / f'{uuid}.pdf'
+            # the metadata is in place before the pdf shows up for the watcher
+            if options['embed_metadata']:
+                add_metadata(download_path, url, uuid, sidecar=False)
+            else:
+                add_metadata(pdf_path, url, uuid)
+            os.replace(download_path, pdf_path)
+            self.stdout.write(f'{url} downloaded to {pdf_path}')
+        if failures:
+            raise CommandError(f'{len(failures)} of {len(downloads)} downloads failed')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from datetime import timedelta
+from lsma.regenerate import flush_page_text
+
+class Command(BaseCommand):
+    help = 'Rebuild the text of pages whose words were edited, keep one running next to the site'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=10, help='seconds between checks for edited pages')
+        parser.add_argument('--quiet', type=float, default=30, help='seconds without word edits before a page is rebuilt')
+        parser.add_argument('--workers', type=int, default=1, help='number of processes turning words into text')
+        parser.add_argument('--once', action='store_true', help='rebuild what is waiting and stop')
+
+    def handle(self, *args, **options):
+        flush_page_text(options['interval'], timedelta(seconds=options['quiet']), options['once'], options['workers'])
+        self.stdout.write('stopped')
@@ -1,28 +1,54 @@
 from django.core.management.base import BaseCommand, CommandError
-from lsma.pdf import add_book
+from lsma.jobs import enqueue
+from lsma.models import Job
+from lsma.pdf import add_book, import_books, DuplicateBook, ImportInProgress, UnfinishedImport
 from pathlib import Path
-import requests
 from uuid import uuid4
 
-def download_url(url: str, new_name: Path) -> None:
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(new_name, 'wb') as f:
-            for chunk in r.iter_content(chunk_size = 16*1024):
-                f.write(chunk)
-
 class Command(BaseCommand):
     help = 'Import files to database'
 
     def add_arguments(self, parser):
         parser.add_argument('paths', nargs='+', type=str, help='file paths')
+        parser.add_argument('--ocr-workers', type=int, default=1, help='number of processes to run tesseract in')
+        parser.add_argument('--workers', type=int, default=1, help='number of books to import at the same time')
+        parser.add_argument('--resume', action='store_true', help='commit pages as they are imported and continue unfinished imports')
+        parser.add_argument('--queue', action='store_true', help='queue the imports for run_jobs instead of running them here')
+        parser.add_argument('--priority', type=int, default=0, help='priority of queued jobs, higher runs first')
 
     def handle(self, *args, **options):
         paths = options['paths']
+        if options['queue']:
+            # queued imports are always resumable, a retry carries on where the last attempt stopped
+            for pdf_path in paths:
+                job = enqueue(Job.Kind.IMPORT, options['priority'], path=pdf_path, ocr_workers=options['ocr_workers'])
+                self.stdout.write(f'queued {pdf_path} as job {job.id}')
+            return
+        if options['workers'] > 1:
+            self.import_batch(paths, options['workers'], options['ocr_workers'], options['resume'])
+            return
         for pdf_path in paths:
             self.stdout.write(f'importing {pdf_path}')
             try:
-                add_book(pdf_path)
+                add_book(pdf_path, ocr_workers=options['ocr_workers'], resumable=options['resume'])
+            except DuplicateBook as e:
+                self.stdout.write(f'skipping {pdf_path}: {e}')
+                continue
+            except ImportInProgress as e:
+                self.stdout.write(f'skipping {pdf_path}: {e}')
+                continue
+            except UnfinishedImport:
+                raise CommandError('the last import of this file never finished, use --resume')
             except ValueError:
                 raise CommandError('file already in db, use reimport_file command')
-            self.stdout.write(f'done with {pdf_path}')
\ No newline at end of file
+            self.stdout.write(f'done with {pdf_path}')
+
+    def import_batch(self, paths, workers, ocr_workers, resume):
+        self.stdout.write(f'importing {len(paths)} files with {workers} workers')
+        results = import_books(paths, workers, ocr_workers=ocr_workers, resumable=resume)
+        failures = [(pdf_path, error) for pdf_path, error in results if error]
+        self.stdout.write(f'imported {len(results) - len(failures)} of {len(results)} files')
+        for pdf_path, error in failures:
+            self.stderr.write(f'{pdf_path}: {error}')
+        if failures:
+            raise CommandError(f'{len(failures)} files failed to import')
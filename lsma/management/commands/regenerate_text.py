@@ -1,9 +1,43 @@
 from django.core.management.base import BaseCommand, CommandError
-from lsma.models import Page
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time
+from lsma.jobs import enqueue
+from lsma.models import Job, Page
+from lsma.regenerate import get_stale_pages, regenerate_text
 
 class Command(BaseCommand):
-    help = 'Regenerate text for all pages'
+    help = 'Regenerate text for pages whose word boxes changed since their text was generated'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='regenerate text for every page')
+        parser.add_argument('--since', type=str, help='only pages with word boxes changed after this date or datetime')
+        parser.add_argument('--dry-run', action='store_true', help='count the pages that would be regenerated')
+        parser.add_argument('--workers', type=int, default=1, help='number of processes turning words into text')
+        parser.add_argument('--batch-size', type=int, default=1000, help='pages read and written at a time')
+        parser.add_argument('--queue', action='store_true', help='queue the regeneration for run_jobs instead of running it here')
+        parser.add_argument('--priority', type=int, default=0, help='priority of the queued job, higher runs first')
 
     def handle(self, *args, **options):
-        for page in Page.objects.all():
-            page.generate_text()
\ No newline at end of file
+        since = None
+        if options['since']:
+            if options['all']:
+                raise CommandError('--since and --all can not be used together')
+            since = parse_datetime(options['since'])
+            if since is None and (date := parse_date(options['since'])):
+                since = datetime.combine(date, time())
+            if since is None:
+                raise CommandError(f'could not read {options["since"]} as a date')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        pages = Page.objects.all() if options['all'] else get_stale_pages(since)
+        if options['dry_run']:
+            self.stdout.write(f'{pages.count()} pages would be regenerated')
+            return
+        if options['queue']:
+            job = enqueue(Job.Kind.REGENERATE_TEXT, options['priority'], workers=options['workers'],
+                          stale_only=not options['all'], since=since.isoformat() if since else None)
+            self.stdout.write(f'queued job {job.id}')
+            return
+        count = regenerate_text(pages, workers=options['workers'], batch_size=options['batch_size'])
+        self.stdout.write(f'regenerated text for {count} pages')
@@ -1,32 +1,31 @@
 from django.core.management.base import BaseCommand, CommandError
-from lsma.pdf import add_book, remove_book, get_metadata
-from pathlib import Path
-import requests
-from uuid import uuid4
-import shutil
-
-def download_url(url: str, new_name: Path) -> None:
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(new_name, 'wb') as f:
-            for chunk in r.iter_content(chunk_size = 16*1024):
-                f.write(chunk)
+from lsma.jobs import enqueue
+from lsma.models import Job
+from lsma.pdf import reimport_book, update_book
 
 class Command(BaseCommand):
     help = 'Reimport file to database'
 
     def add_arguments(self, parser):
         parser.add_argument('paths', nargs='+', type=str, help='file paths')
+        parser.add_argument('--ocr-workers', type=int, default=1, help='number of processes to run tesseract in')
+        parser.add_argument('--incremental', action='store_true', help='only reimport pages whose image or ocr config changed')
+        parser.add_argument('--queue', action='store_true', help='queue the reimports for run_jobs instead of running them here')
+        parser.add_argument('--priority', type=int, default=0, help='priority of queued jobs, higher runs first')
 
     def handle(self, *args, **options):
         paths = options['paths']
         for pdf_path in paths:
-            uuid, _, _= get_metadata(pdf_path)
-            original_image_path = Path(f'original_page_images/{str(uuid)[:8]}')
-            self.stdout.write(f'removing {pdf_path}')
-            remove_book(uuid)
-            self.stdout.write(f'deleting previously extracted images for {pdf_path}')
-            shutil.rmtree(original_image_path)
+            if options['queue']:
+                job = enqueue(Job.Kind.REIMPORT, options['priority'], path=pdf_path,
+                              incremental=options['incremental'], ocr_workers=options['ocr_workers'])
+                self.stdout.write(f'queued {pdf_path} as job {job.id}')
+                continue
+            if options['incremental']:
+                self.stdout.write(f'updating {pdf_path}')
+                update_book(pdf_path, ocr_workers=options['ocr_workers'])
+                self.stdout.write(f'done with {pdf_path}')
+                continue
             self.stdout.write(f'reimporting {pdf_path}')
-            add_book(pdf_path)
-            self.stdout.write(f'done with {pdf_path}')
\ No newline at end of file
+            reimport_book(pdf_path, ocr_workers=options['ocr_workers'])
+            self.stdout.write(f'done with {pdf_path}')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from lsma.reocr import get_low_confidence_pages, reocr_pages
+
+class Command(BaseCommand):
+    help = 'Re-ocr pages with low word confidence using heavier settings, keeping whichever result is better'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', nargs='+', type=str, help='only pages of books with these uuids')
+        parser.add_argument('--mean-below', type=float, default=75, help='pages whose mean word confidence is below this')
+        parser.add_argument('--percentile', type=float, default=0.1, help='percentile of word confidence to check')
+        parser.add_argument('--percentile-below', type=float, default=30, help='pages whose confidence at the percentile is below this')
+        parser.add_argument('--min-gain', type=float, default=1.0, help='how much better a new result has to score to replace the old one')
+        parser.add_argument('--limit', type=int, help='only the worst pages, at most this many')
+        parser.add_argument('--workers', type=int, default=1, help='number of ocr processes for each setting')
+        parser.add_argument('--dry-run', action='store_true', help='report what would change without saving')
+
+    def handle(self, *args, **options):
+        if not 0 < options['percentile'] < 1:
+            raise CommandError('--percentile has to be between 0 and 1')
+        pages = get_low_confidence_pages(options['mean_below'], options['percentile'], options['percentile_below'], options['books'])
+        pages = pages.select_related('book')
+        if options['limit']:
+            pages = pages[:options['limit']]
+        pages = list(pages)
+        self.stdout.write(f'{len(pages)} pages with low confidence')
+        improved = reocr_pages(pages, options['workers'], options['min_gain'], options['dry_run'])
+        self.stdout.write(f'{"would improve" if options["dry_run"] else "improved"} {improved} of {len(pages)} pages')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from datetime import timedelta
+from lsma.jobs import work
+from lsma.models import Job
+
+class Command(BaseCommand):
+    help = 'Run queued import, reimport and text jobs, start as many as you like on any machine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kinds', nargs='+', choices=Job.Kind.values, help='only run jobs of these kinds')
+        parser.add_argument('--poll-interval', type=float, default=5, help='seconds between checks of an empty queue')
+        parser.add_argument('--stale-after', type=float, default=60, help='minutes without progress before a running job is taken to be dead')
+        parser.add_argument('--once', action='store_true', help='stop when the queue is empty')
+
+    def handle(self, *args, **options):
+        work(options['kinds'], options['poll_interval'], options['once'], timedelta(minutes=options['stale_after']))
+        self.stdout.write('stopped')
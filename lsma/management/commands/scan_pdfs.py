@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from lsma.inbox import scan_inbox, get_import_status
+from collections import Counter
+from pathlib import Path
+
+class Command(BaseCommand):
+    help = 'List the pdfs in the download directory and which of them are not in the database yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', type=str, default='new_pdf_downloads', help='directory to scan')
+        parser.add_argument('--workers', type=int, default=8, help='number of processes reading metadata')
+        parser.add_argument('--all', action='store_true', help='list every file, not just the ones still to import')
+
+    def handle(self, *args, **options):
+        folder = Path(options['folder'])
+        if not folder.is_dir():
+            raise CommandError(f'{folder} is not a directory')
+        manifest = scan_inbox(folder, options['workers'])
+        status = get_import_status(manifest)
+        for name, file_status in status.items():
+            if options['all'] or file_status != 'imported':
+                entry = manifest[name]
+                error = f' ({entry["error"]})' if entry.get('error') else ''
+                self.stdout.write(f'{file_status:>10}  {folder / name}  {entry["size"]}  {entry["url"] or ""}{error}')
+        counts = Counter(status.values())
+        self.stdout.write(', '.join(f'{count} {file_status}' for file_status, count in sorted(counts.items())) or 'no pdfs found')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from lsma.inbox import watch_inbox
+from pathlib import Path
+
+class Command(BaseCommand):
+    help = 'Watch the download directory and import new pdfs as they arrive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', type=str, default='new_pdf_downloads', help='directory to watch')
+        parser.add_argument('--workers', type=int, default=2, help='number of books to import at the same time')
+        parser.add_argument('--ocr-workers', type=int, default=1, help='number of processes to run tesseract in for each book')
+        parser.add_argument('--poll-interval', type=float, default=5, help='seconds between checks of the directory')
+        parser.add_argument('--settle', type=float, default=30, help='seconds a file has to stay unchanged before it is imported')
+
+    def handle(self, *args, **options):
+        folder = Path(options['folder'])
+        if not folder.is_dir():
+            raise CommandError(f'{folder} is not a directory')
+        self.stdout.write(f'watching {folder}')
+        watch_inbox(folder, options['workers'], options['ocr_workers'], options['poll_interval'], options['settle'])
+        self.stdout.write('stopped')
@@ -0,0 +1,130 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from django.conf import settings
+from pathlib import Path
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+def timed(function, *args, **kwargs):
+    # returns the result together with the seconds it took, for timing work
+    # done in another process
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def write_event(event: dict) -> None:
+    if not settings.METRICS_FILE:
+        return
+    path = Path(settings.METRICS_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    line = json.dumps({'time': datetime.now(timezone.utc).isoformat(), **event}) + '\n'
+    # one write per line in append mode, so imports running at the same time don't interleave
+    with open(path, 'a') as f:
+        f.write(line)
+
+def read_prometheus(path: Path) -> dict:
+    values = {}
+    if path.exists():
+        for line in path.read_text().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+    return values
+
+def export_prometheus(seconds: dict, counts: dict) -> None:
+    # adds to the running totals in a textfile for node_exporter's textfile
+    # collector. every import process adds to the same file, so it is locked
+    if not settings.METRICS_PROMETHEUS_FILE:
+        return
+    path = Path(settings.METRICS_PROMETHEUS_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        values = read_prometheus(path)
+        for stage, value in seconds.items():
+            key = f'lsma_ingest_stage_seconds_total{{stage="{stage}"}}'
+            values[key] = values.get(key, 0) + value
+        for item, value in counts.items():
+            key = f'lsma_ingest_items_total{{item="{item}"}}'
+            values[key] = values.get(key, 0) + value
+        values['lsma_ingest_books_total'] = values.get('lsma_ingest_books_total', 0) + 1
+        lines = []
+        for name in ['lsma_ingest_stage_seconds_total', 'lsma_ingest_items_total', 'lsma_ingest_books_total']:
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{key} {value}' for key, value in sorted(values.items()) if key.split('{')[0] == name)
+        temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        temp_path.write_text('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+
+class IngestMetrics:
+    # seconds spent in each stage of an import and counts of what went through
+    # it, for every page and for the whole book. stages overlap (pages are
+    # extracted while others are in ocr), so they add up to more than the wall
+    # time. a line is written to METRICS_FILE as each page is added and a
+    # summary once the book is done
+    def __init__(self, book, pdf_path):
+        self.book = str(book.uuid)
+        self.pdf_path = str(pdf_path)
+        self.started = time.perf_counter()
+        # the extraction thread adds to these as well
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.page_seconds = defaultdict(lambda: defaultdict(float))
+        self.page_counts = defaultdict(lambda: defaultdict(int))
+        self.counts['pdf_bytes'] = os.path.getsize(pdf_path)
+
+    @contextmanager
+    def stage(self, name, page=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, page)
+
+    def add_time(self, name, seconds, page=None):
+        with self.lock:
+            self.seconds[name] += seconds
+            if page is not None:
+                self.page_seconds[page][name] += seconds
+
+    def count(self, name, value=1, page=None):
+        with self.lock:
+            self.counts[name] += value
+            if page is not None:
+                self.page_counts[page][name] += value
+
+    def finish_page(self, page):
+        with self.lock:
+            seconds = self.page_seconds.pop(page, {})
+            counts = self.page_counts.pop(page, {})
+            self.counts['pages'] += 1
+        write_event({
+            'event': 'page',
+            'book': self.book,
+            'page': page,
+            'seconds': {name: round(value, 4) for name, value in seconds.items()},
+            **counts,
+        })
+
+    def finish(self):
+        wall = time.perf_counter() - self.started
+        pages = self.counts['pages']
+        write_event({
+            'event': 'book',
+            'book': self.book,
+            'path': self.pdf_path,
+            'wall_seconds': round(wall, 3),
+            'pages_per_second': round(pages / wall, 3) if wall else None,
+            'seconds': {name: round(value, 3) for name, value in self.seconds.items()},
+            **self.counts,
+        })
+        export_prometheus(self.seconds, self.counts)
+        stages = ', '.join(f'{name} {value:.1f}s' for name, value in sorted(self.seconds.items(), key=lambda item: -item[1]))
+        print(f'{pages} pages of {self.pdf_path} in {wall:.1f}s ({stages})')
@@ -0,0 +1,24 @@
+# Generated by Django 4.0.3 on 2026-10-18 08:30
+
+from django.db import migrations, models
+
+
+def mark_existing_books_imported(apps, schema_editor):
+    Book = apps.get_model('lsma', 'Book')
+    Book.objects.filter(imported_at__isnull=True).update(imported_at=models.F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0038_alter_graphic_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='imported_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_existing_books_imported, migrations.RunPython.noop),
+    ]
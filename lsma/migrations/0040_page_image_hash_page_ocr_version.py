@@ -0,0 +1,23 @@
+# Generated by Django 4.0.3 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0039_book_imported_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='ocr_version',
+            field=models.CharField(blank=True, max_length=63),
+        ),
+    ]
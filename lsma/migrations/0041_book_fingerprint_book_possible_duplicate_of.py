@@ -0,0 +1,24 @@
+# Generated by Django 4.0.3 on 2026-10-18 08:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0040_page_image_hash_page_ocr_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='possible_duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='possible_duplicates', to='lsma.book'),
+        ),
+    ]
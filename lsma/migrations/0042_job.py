@@ -0,0 +1,39 @@
+# Generated by Django 4.0.3 on 2026-10-18 08:38
+
+from django.db import migrations, models
+import django.utils.timezone
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0041_book_fingerprint_book_possible_duplicate_of'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('kind', models.CharField(choices=[('IMP', 'Import'), ('REI', 'Reimport'), ('TXT', 'Regenerate Text')], max_length=3)),
+                ('arguments', models.JSONField(blank=True, default=dict)),
+                ('priority', models.SmallIntegerField(default=0)),
+                ('status', models.CharField(choices=[('QUE', 'Queued'), ('RUN', 'Running'), ('DON', 'Done'), ('FAI', 'Failed')], default='QUE', max_length=3)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField(default=3)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('progress', models.FloatField(default=0)),
+                ('worker', models.CharField(blank=True, max_length=127)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', '-priority', 'run_after'], name='lsma_job_status_04bee4_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.3 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+def copy_page_numbers(apps, schema_editor):
+    # every page so far is a whole page of its pdf
+    Page = apps.get_model('lsma', 'Page')
+    Page.objects.update(pdf_page_number=models.F('number'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0042_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='pdf_page_number',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='spread_half',
+            field=models.CharField(blank=True, choices=[('L', 'Left'), ('R', 'Right')], default=None, max_length=1, null=True),
+        ),
+        migrations.RunPython(copy_page_numbers, migrations.RunPython.noop),
+    ]
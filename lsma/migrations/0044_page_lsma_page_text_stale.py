@@ -0,0 +1,17 @@
+# Generated by Django 4.0.3 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0043_page_pdf_page_number_page_spread_half'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='page',
+            index=models.Index(condition=models.Q(('text_generated_at__isnull', True)), fields=['id'], name='lsma_page_text_stale'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.0.3 on 2026-10-18 09:40
+
+from django.db import migrations
+
+
+def clear_text_layer_confidence(apps, schema_editor):
+    # words read from a pdf's text layer were given a confidence of 100
+    Box = apps.get_model('lsma', 'Box')
+    Box.objects.filter(page__ocr_version__startswith='pdfium-', level=5).update(original_confidence=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lsma', '0044_page_lsma_page_text_stale'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_text_layer_confidence, migrations.RunPython.noop),
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth.models import User
 from treenode.models import TreeNodeModel
 from django.utils.html import mark_safe
+from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField
 from django_extensions.db.models import TimeStampedModel
 from imagekit.models import ImageSpecField
@@ -98,8 +99,16 @@ class Page(TimeStampedModel):
         COUNTERCLOCKWISE = 'L'
         UPSIDE_DOWN = 'U'
 
+    class Half(models.TextChoices):
+        LEFT = 'L'
+        RIGHT = 'R'
+
     book = models.ForeignKey('Book', on_delete=models.CASCADE, related_name='pages')
     number = models.PositiveSmallIntegerField(blank=True, null=True)
+    # the page of the pdf the image came from, two pages share it when a
+    # scan of a two page spread was split
+    pdf_page_number = models.PositiveSmallIntegerField(blank=True, null=True)
+    spread_half = models.CharField(max_length=1, blank=True, null=True, default=None, choices=Half.choices)
     topics = models.ManyToManyField(Topic, blank=True, related_name='pages')
     original_image = models.ImageField(unique=True, width_field='width', height_field='height')
     thumbnail = ImageSpecField(source='original_image',
@@ -113,6 +122,8 @@ class Page(TimeStampedModel):
     width = models.PositiveSmallIntegerField(blank=True, null=True)
     search_text = models.TextField(blank=True)
     text_generated_at = models.DateTimeField(blank=True, null=True)
+    image_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    ocr_version = models.CharField(max_length=63, blank=True)
     # sections (MtM)
     # section_headings (OtM)
     # tables (MtM)
@@ -132,6 +143,8 @@ class Page(TimeStampedModel):
 
     class Meta:
         ordering = ['number']
+        # the pages flush_page_text is waiting to rebuild
+        indexes = [models.Index(fields=['id'], condition=models.Q(text_generated_at__isnull=True), name='lsma_page_text_stale')]
 
     def get_absolute_url(self):
         return f'{self.book.get_absolute_url()}/page/{self.number}'
@@ -152,11 +165,12 @@ class Page(TimeStampedModel):
             return None
 
     def generate_text(self):
+        self.text_generated_at = timezone.now()
         word_boxes = self.boxes.filter(level=Box.Level.WORD)
         word_list = [box.text for box in word_boxes]
         text = word_list_to_text(word_list)
         self.search_text = text
-        self.save()
+        self.save(update_fields=['search_text', 'text_generated_at', 'modified'])
 
 
 class Section(TreeNodeModel, TimeStampedModel):
@@ -250,6 +264,9 @@ class Book(TimeStampedModel):
     uuid = models.UUIDField(max_length=36, null=True, blank=True, unique=True)
     url = models.URLField(blank=True, null=True)
     downloaded_at = models.DateTimeField(null=True, blank=True)
+    imported_at = models.DateTimeField(null=True, blank=True)
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    possible_duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='possible_duplicates')
     date_published = models.DateField(null=True, blank=True)
     publishing_frequency = models.CharField(max_length=1, choices=PublishingFrequency.choices, blank=True)
     scan_color = models.CharField(max_length=3, choices=Color.choices, blank=True)
@@ -441,10 +458,18 @@ class Box(TimeStampedModel):
         return f'{self.page.get_absolute_url()}/box/{self.id}'
 
     def save(self, *args, **kwargs):
-        if self.level == Level.WORD:
-            # TODO: test if the word changed before doing this:
-            self.page.generate_text()
+        from .regenerate import mark_text_dirty
         super(Box, self).save(*args, **kwargs)
+        if self.level == self.Level.WORD:
+            # the page's text is rebuilt later, once for all of its edited words
+            mark_text_dirty(self.page_id)
+
+    def delete(self, *args, **kwargs):
+        from .regenerate import mark_text_dirty
+        result = super(Box, self).delete(*args, **kwargs)
+        if self.level == self.Level.WORD:
+            mark_text_dirty(self.page_id)
+        return result
 
 
 class BookCheck(models.Model):
@@ -537,4 +562,36 @@ class OcrFix(TimeStampedModel):
     decided_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
-        verbose_name_plural = 'ocr fixes'
\ No newline at end of file
+        verbose_name_plural = 'ocr fixes'
+
+class Job(TimeStampedModel):
+    class Kind(models.TextChoices):
+        IMPORT = 'IMP'
+        REIMPORT = 'REI'
+        REGENERATE_TEXT = 'TXT'
+
+    class Status(models.TextChoices):
+        QUEUED = 'QUE'
+        RUNNING = 'RUN'
+        DONE = 'DON'
+        FAILED = 'FAI'
+
+    kind = models.CharField(max_length=3, choices=Kind.choices)
+    arguments = models.JSONField(default=dict, blank=True)
+    # higher runs first
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=3, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    progress = models.FloatField(default=0)
+    worker = models.CharField(max_length=127, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', '-priority', 'run_after'])]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.arguments} ({self.get_status_display()})'
@@ -0,0 +1,310 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from pathlib import Path
+from typing import NamedTuple
+import fcntl
+import gzip
+import hashlib
+import multiprocessing
+import os
+import pytesseract
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+from .models import Page
+from .orientation import looks_sideways, make_upright, rotation_from_degrees, to_original
+from .preprocess import config_version, preprocess
+
+
+class BoxRecord(NamedTuple):
+    level: int
+    page_number: int
+    block_number: int
+    paragraph_number: int
+    line_number: int
+    word_number: int
+    left: int
+    top: int
+    width: int
+    height: int
+    confidence: float | None
+    text: str
+
+
+def parse_tsv(tsv: str) -> list[BoxRecord]:
+    records = []
+    for line in tsv.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 11 or fields[0] == 'level':
+            continue
+        confidence = float(fields[10])
+        records.append(BoxRecord(
+            *(int(field) for field in fields[:10]),
+            confidence=None if confidence == -1 else confidence,
+            text=fields[11] if len(fields) > 11 else '',
+        ))
+    return records
+
+
+class SubprocessEngine:
+    # runs the tesseract executable once per page through pytesseract
+    name = 'tesseract'
+
+    def __init__(self, lang='eng', psm=None, tessdata_dir=None):
+        self.lang = lang
+        self.config = ' '.join(
+            ([f'--psm {psm}'] if psm is not None else []) +
+            ([f'--tessdata-dir {tessdata_dir}'] if tessdata_dir else []))
+        self.version = engine_version(self.name, lang, psm, tessdata_dir, preprocess_config=False)
+
+    def tsv(self, image: Image.Image) -> str:
+        return pytesseract.image_to_data(image, lang=self.lang, config=self.config)
+
+    def osd(self, image: Image.Image) -> int | None:
+        # degrees to turn the image clockwise to make it upright
+        try:
+            return pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)['rotate']
+        except pytesseract.TesseractError:
+            return None
+
+
+class TesserocrEngine:
+    # talks to libtesseract directly, the model is loaded once when the engine
+    # is created and reused for every page after that
+    name = 'tesserocr'
+
+    def __init__(self, lang='eng', psm=None, tessdata_dir=None):
+        options = {'lang': lang}
+        if psm is not None:
+            options['psm'] = psm
+        if tessdata_dir:
+            options['path'] = tessdata_dir
+        self.api = tesserocr.PyTessBaseAPI(**options)
+        # only loaded when a page needs it
+        self.osd_api = None
+        self.version = engine_version(self.name, lang, psm, tessdata_dir, preprocess_config=False)
+
+    def tsv(self, image: Image.Image) -> str:
+        self.api.SetImage(image)
+        self.api.Recognize()
+        return self.api.GetTSVText(0)
+
+    def osd(self, image: Image.Image) -> int | None:
+        # degrees to turn the image clockwise to make it upright
+        if self.osd_api is None:
+            self.osd_api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.OSD_ONLY)
+        self.osd_api.SetImage(image)
+        result = self.osd_api.DetectOrientationScript()
+        return (360 - result['orient_deg']) % 360 if result else None
+
+
+class OcrCache:
+    # tesseract output kept on disk, keyed by the image pixels and the engine
+    # version and config. the raw tsv is stored rather than parsed boxes, so
+    # fixes to parsing still apply to cached pages. files are touched on every
+    # hit and trim removes the least recently used ones first. the size of the
+    # cache is kept as a running total (the size at the last trim plus a line
+    # for every file put since), so trim only walks the files when it is over
+    def __init__(self, folder, max_bytes):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+
+    def key(self, image: Image.Image, version: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(f'{version}:{image.mode}:{image.width}x{image.height}:'.encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.folder / key[:2] / f'{key}.tsv.gz'
+
+    def get(self, key: str) -> str | None:
+        path = self.path(key)
+        try:
+            with gzip.open(path, 'rt') as f:
+                tsv = f.read()
+        except (FileNotFoundError, EOFError, OSError):
+            return None
+        os.utime(path)
+        return tsv
+
+    def put(self, key: str, tsv: str) -> None:
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # written to a temporary name first so other workers never read half a file
+        temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with gzip.open(temp_path, 'wt') as f:
+            f.write(tsv)
+        size = temp_path.stat().st_size
+        os.replace(temp_path, path)
+        with open(self.folder / 'added', 'a') as f:
+            f.write(f'{size}\n')
+
+    def get_size(self) -> int | None:
+        # None until the first trim has counted the files. what was put since
+        # the last count is folded into it, other processes carry on
+        # appending to a new added file
+        try:
+            size = int((self.folder / 'size').read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        added_path = self.folder / 'added'
+        counting_path = self.folder / f'added.{os.getpid()}'
+        try:
+            added_path.rename(counting_path)
+        except FileNotFoundError:
+            return size
+        size += sum(int(line) for line in counting_path.read_text().split())
+        self.set_size(size)
+        counting_path.unlink()
+        return size
+
+    def set_size(self, size: int) -> None:
+        temp_path = self.folder / f'size.{os.getpid()}.tmp'
+        temp_path.write_text(str(size))
+        os.replace(temp_path, self.folder / 'size')
+
+    def trim(self) -> None:
+        if not self.folder.exists():
+            return
+        with open(self.folder / 'lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            size = self.get_size()
+            if size is not None and size <= self.max_bytes:
+                return
+            # files put while this runs are in the next added file, some of
+            # them are counted twice and the next trim just comes a bit early
+            (self.folder / 'added').unlink(missing_ok=True)
+            files = [(entry.stat(), entry) for entry in self.folder.glob('*/*.tsv.gz')]
+            total = sum(stat.st_size for stat, _ in files)
+            if total > self.max_bytes:
+                files.sort(key=lambda file: file[0].st_mtime)
+                for stat, path in files:
+                    if total <= self.max_bytes:
+                        break
+                    path.unlink(missing_ok=True)
+                    total -= stat.st_size
+                print(f'trimmed ocr cache to {total} bytes')
+            self.set_size(total)
+
+
+def get_cache() -> OcrCache | None:
+    if not settings.OCR_CACHE_DIR:
+        return None
+    return OcrCache(settings.OCR_CACHE_DIR, settings.OCR_CACHE_MAX_BYTES)
+
+
+engines = {
+    SubprocessEngine.name: SubprocessEngine,
+    TesserocrEngine.name: TesserocrEngine,
+}
+
+def default_engine_name():
+    return TesserocrEngine.name if tesserocr else SubprocessEngine.name
+
+def engine_version(name=None, lang='eng', psm=None, tessdata_dir=None, preprocess_config=None):
+    # identifies everything that changes the ocr output for the same image.
+    # preprocess_config is the settings' preprocessing when None, False
+    # leaves it out (the engines' own versions, the cache sees the
+    # preprocessed pixels)
+    name = name or default_engine_name()
+    if name == TesserocrEngine.name:
+        version = tesserocr.tesseract_version().split()[1]
+    else:
+        version = pytesseract.get_tesseract_version()
+    version = f'{name}-{version}-{lang}'
+    if psm is not None:
+        version += f'-psm{psm}'
+    if tessdata_dir:
+        version += f'-{Path(tessdata_dir).name}'
+    if settings.OCR_PREPROCESS and preprocess_config is not False:
+        version += f'-{config_version(preprocess_config)}'
+    return version
+
+# one engine per process, created by init_engine when an ocr worker starts
+engine = None
+
+def init_engine(name=None, psm=None, tessdata_dir=None):
+    global engine
+    engine = engines[name or default_engine_name()](psm=psm, tessdata_dir=tessdata_dir)
+
+def get_boxes(image: Image.Image | str, use_cache=True, preprocess_config=None) -> list[BoxRecord]:
+    # boxes are in the coordinates of the image passed in, whatever the
+    # preprocessing did to the image tesseract saw
+    if engine is None:
+        init_engine()
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    transform = None
+    if settings.OCR_PREPROCESS:
+        image, transform = preprocess(image, preprocess_config)
+    cache = get_cache() if use_cache else None
+    if cache is None:
+        tsv = engine.tsv(image)
+    else:
+        key = cache.key(image, engine.version)
+        tsv = cache.get(key)
+        if tsv is None:
+            tsv = engine.tsv(image)
+            cache.put(key, tsv)
+    records = parse_tsv(tsv)
+    if transform:
+        records = [transform.to_original(record) for record in records]
+    return records
+
+def word_values(records) -> list[tuple[float | None, str]]:
+    return [(record.confidence, record.text) for record in records if record.level == 5]
+
+def score(values) -> float | None:
+    # mean word confidence weighted by word length, so a run of confidently
+    # read punctuation doesn't outweigh the words around it. values are
+    # (confidence, text) pairs
+    weighted = [(confidence, len(text.strip())) for confidence, text in values if confidence is not None and text.strip()]
+    total = sum(length for _, length in weighted)
+    return sum(confidence * length for confidence, length in weighted) / total if total else None
+
+def get_page_boxes(image: Image.Image | str, use_cache=True, preprocess_config=None, rotation=None) -> tuple[list[BoxRecord], str | None]:
+    # get_boxes for a page that may be sideways. pages whose lines run up and
+    # down are turned upright before ocr, osd says which way, unless the
+    # Page.Rotation is already known. returns the records in the coordinates
+    # of the image passed in and the rotation of its text, None if upright
+    if engine is None:
+        init_engine()
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    candidates = [rotation]
+    if rotation is None and settings.DETECT_ROTATION and looks_sideways(image):
+        degrees = engine.osd(image)
+        if degrees is None:
+            # osd gives up on pages with little text, which is also when
+            # looks_sideways is easily wrong. upright and both ways sideways
+            # are tried instead, upright wins a tie
+            candidates = [None, Page.Rotation.CLOCKWISE, Page.Rotation.COUNTERCLOCKWISE]
+        else:
+            candidates = [rotation_from_degrees(degrees)]
+    results = []
+    for rotation in candidates:
+        records = get_boxes(make_upright(image, rotation), use_cache, preprocess_config)
+        results.append((score(word_values(records)) or 0, rotation, records))
+    _, rotation, records = max(results, key=lambda result: result[0])
+    return [to_original(record, rotation, image.size) for record in records], rotation
+
+def ocr_pool(workers, engine_name=None, psm=None, tessdata_dir=None):
+    # long lived ocr workers, each keeps its engine (and language model) for as
+    # long as the pool is open. pages go in over ipc and box records come back
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=init_engine,
+        initargs=(engine_name, psm, tessdata_dir),
+    )
+    # a fork pool starts all of its workers with the first task. they are
+    # forked here, before the caller starts threads of its own (add_pages
+    # extracts pages in one), a child forked in the middle of pikepdf or
+    # pdfium work in another thread can deadlock
+    executor.submit(int).result()
+    return executor
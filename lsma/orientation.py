@@ -0,0 +1,54 @@
+from PIL import Image
+import numpy as np
+
+from .models import Page
+from .preprocess import get_crop, otsu_threshold
+
+# pages are shrunk to this many pixels on their longest side to check them
+sample_size = 800
+
+# the transpose that turns text rotated this way upright
+corrections = {
+    Page.Rotation.CLOCKWISE: Image.ROTATE_90,
+    Page.Rotation.COUNTERCLOCKWISE: Image.ROTATE_270,
+    Page.Rotation.UPSIDE_DOWN: Image.ROTATE_180,
+}
+
+
+def gap_fraction(profile: np.ndarray) -> float:
+    # the share of rows (or columns) with next to no ink. lines of text leave
+    # gaps between them across the lines, not along them
+    return float((profile < 0.05 * profile.max()).mean()) if profile.max() else 0.0
+
+def looks_sideways(image: Image.Image) -> bool:
+    # cheap check from the ink profiles whether the lines run up and down
+    # the page, it can't tell which way the text is turned
+    image = image.convert('L')
+    image.thumbnail((sample_size, sample_size))
+    gray = np.asarray(image)
+    ink = gray <= otsu_threshold(gray)
+    left, top, right, bottom = get_crop(ink, padding=0)
+    ink = ink[top:bottom, left:right]
+    if ink.size == 0 or ink.mean() < 0.005:
+        return False
+    row_gaps = gap_fraction(ink.sum(axis=1))
+    column_gaps = gap_fraction(ink.sum(axis=0))
+    return column_gaps > 0.15 and column_gaps > 2 * row_gaps
+
+def rotation_from_degrees(degrees: int) -> str | None:
+    # degrees is how far tesseract's osd says to turn the image clockwise
+    return {90: Page.Rotation.COUNTERCLOCKWISE, 180: Page.Rotation.UPSIDE_DOWN, 270: Page.Rotation.CLOCKWISE}.get(degrees % 360)
+
+def make_upright(image: Image.Image, rotation) -> Image.Image:
+    return image.transpose(corrections[rotation]) if rotation else image
+
+def to_original(record, rotation, original_size):
+    # maps a box record from the upright image back to the stored image
+    width, height = original_size
+    if rotation == Page.Rotation.CLOCKWISE:
+        return record._replace(left=width - record.top - record.height, top=record.left, width=record.height, height=record.width)
+    if rotation == Page.Rotation.COUNTERCLOCKWISE:
+        return record._replace(left=record.top, top=height - record.left - record.width, width=record.height, height=record.width)
+    if rotation == Page.Rotation.UPSIDE_DOWN:
+        return record._replace(left=width - record.left - record.width, top=height - record.top - record.height)
+    return record
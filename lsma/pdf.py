@@ -1,16 +1,36 @@
-from pikepdf import Pdf, PdfImage
+from pikepdf import Array, Dictionary, Name, Pdf, PdfImage, Stream, String, parse_content_stream
 from pikepdf.models.metadata import PdfMetadata
 from lxml import etree
 from uuid import UUID
-import pytesseract
 from PIL import Image
 from pathlib import Path
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Count, Q
 from django.db.utils import IntegrityError
 from datetime import datetime, timezone
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from typing import NamedTuple
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
 
-import requests
-
-from .models import Book, Page, Box
+from .classify import classifier_prefix, classifier_version, classify_page
+from .models import Book, Box, Page, Section
+from .loader import PageLoader
+from .metrics import IngestMetrics, timed
+from .ocr import BoxRecord, engine_version, get_cache, get_page_boxes, ocr_pool
+from .reocr import profile_versions
+from .spread import find_gutter, split_spread
+from .text import word_list_to_text
+from .vector import get_text_records, open_document, render_page, text_layer_prefix, text_layer_version
 
 prefix = 'lsma'
 uri = 'http://scienceandmaterialculture.org/ns/1.0'
@@ -20,205 +40,748 @@ PdfMetadata.NS[prefix] = uri
 PdfMetadata.REVERSE_NS[uri] = prefix
 
 
-def add_metadata(pdf_path: str, url: str, uuid: UUID) -> None:
+def get_sidecar_path(pdf_path) -> Path:
+    return Path(f'{pdf_path}.lsma.json')
+
+def add_metadata(pdf_path: str, url: str, uuid: UUID, sidecar=True) -> None:
+    # by default the metadata goes into a small json file next to the pdf,
+    # embedding it means rewriting the whole pdf
     print(f'adding metadata for {pdf_path}')
+    now_utc = datetime.now().replace(tzinfo=timezone.utc)
+    if sidecar:
+        sidecar_path = get_sidecar_path(pdf_path)
+        temp_path = sidecar_path.with_name(f'{sidecar_path.name}.tmp')
+        temp_path.write_text(json.dumps({
+            'uuid': str(uuid),
+            'url': url,
+            'downloaded_at': str(now_utc),
+        }))
+        os.replace(temp_path, sidecar_path)
+        return
     with Pdf.open(pdf_path, allow_overwriting_input=True) as pdf:
         with pdf.open_metadata() as meta:
             meta['lsma:UUID'] = str(uuid)
             meta['lsma:URL'] = url
-            now_utc = datetime.now().replace(tzinfo=timezone.utc)
             meta['lsma:Downloaded_at'] = str(now_utc)
         pdf.save()
     return
 
 def get_metadata(pdf_path: str) -> UUID:
+    # reads the sidecar file if there is one, the pdf's xmp metadata otherwise
+    sidecar_path = get_sidecar_path(pdf_path)
+    if sidecar_path.exists():
+        meta = json.loads(sidecar_path.read_text())
+        uuid = meta.get('uuid')
+        url = meta.get('url')
+        downloaded_at = meta.get('downloaded_at')
+    else:
+        with Pdf.open(pdf_path) as pdf:
+            with pdf.open_metadata() as meta:
+                uuid = meta.get('lsma:UUID')
+                url = meta.get('lsma:URL')
+                downloaded_at = meta.get('lsma:Downloaded_at')
+    if uuid:
+        uuid = UUID(hex=uuid)
+    if downloaded_at:
+        downloaded_at = datetime.fromisoformat(downloaded_at)
+    return uuid, url, downloaded_at
+
+
+def multiply(first, second):
+    # pdf matrices (a, b, c, d, e, f), first applied before second
+    a1, b1, c1, d1, e1, f1 = first
+    a2, b2, c2, d2, e2, f2 = second
+    return (a1 * a2 + b1 * c2, a1 * b2 + b1 * d2, c1 * a2 + d1 * c2, c1 * b2 + d1 * d2,
+            e1 * a2 + f1 * c2 + e2, e1 * b2 + f1 * d2 + f2)
+
+def get_image_placements(page) -> dict[str, tuple[float, float, float, float]]:
+    # {xobject name: (left, bottom, right, top)} of where each xobject is drawn
+    # on the page, in pdf units. an image drawn more than once keeps its
+    # biggest placement
+    identity = (1, 0, 0, 1, 0, 0)
+    matrix = identity
+    stack = []
+    placements = {}
+    for operands, operator in parse_content_stream(page, 'q Q cm Do'):
+        operator = str(operator)
+        if operator == 'q':
+            stack.append(matrix)
+        elif operator == 'Q':
+            matrix = stack.pop() if stack else identity
+        elif operator == 'cm':
+            matrix = multiply(tuple(float(operand) for operand in operands), matrix)
+        elif operator == 'Do':
+            a, b, c, d, e, f = matrix
+            # images fill the unit square of the current matrix
+            xs = [e, a + e, c + e, a + c + e]
+            ys = [f, b + f, d + f, b + d + f]
+            box = (min(xs), min(ys), max(xs), max(ys))
+            name = str(operands[0])
+            old = placements.get(name)
+            if old is None or get_area(box) > get_area(old):
+                placements[name] = box
+    return placements
+
+def get_area(box) -> float:
+    return max(box[2] - box[0], 0) * max(box[3] - box[1], 0)
+
+def get_page_image(page, min_coverage=0.9) -> PdfImage | None:
+    # the scan a page is made of: the image drawn over (nearly) all of the
+    # page. born digital pages have none, a figure or logo on them isn't one
+    xobject = page['/Resources'].get('/XObject', {})
+    media_box = [float(value) for value in page.mediabox]
+    page_box = (min(media_box[0], media_box[2]), min(media_box[1], media_box[3]),
+                max(media_box[0], media_box[2]), max(media_box[1], media_box[3]))
+    placements = get_image_placements(page)
+    images = []
+    for name, obj in xobject.items():
+        try:
+            image = PdfImage(obj)
+        except TypeError:
+            continue
+        placement = placements.get(name)
+        if placement is None:
+            continue
+        visible = (max(placement[0], page_box[0]), max(placement[1], page_box[1]),
+                   min(placement[2], page_box[2]), min(placement[3], page_box[3]))
+        if get_area(visible) >= min_coverage * get_area(page_box):
+            images.append(image)
+    images.sort(key=lambda x: x.height)
+    return images[-1] if images else None
+
+def is_google_cover(number, page_image: PdfImage | None) -> bool:
+    return number == 1 and page_image is not None and page_image.height == 750 and page_image.width == 1800
+
+def get_image_hash(page_image: PdfImage) -> str:
+    # hashes the image stream as it is stored in the pdf, no decoding needed
+    return hashlib.sha256(page_image.obj.read_raw_bytes()).hexdigest()
+
+def hash_object(obj, digest, seen):
+    # streams by their bytes and dictionaries and arrays by what is in them,
+    # never by object numbers, which change when a pdf is saved again.
+    # /Parent leads back up the page tree and is left out
+    if isinstance(obj, (Stream, Dictionary, Array)) and obj.is_indirect:
+        if obj.objgen in seen:
+            return
+        seen.add(obj.objgen)
+    if isinstance(obj, Stream):
+        digest.update(obj.read_raw_bytes())
+        obj = obj.stream_dict
+    if isinstance(obj, Dictionary):
+        for key in sorted(obj.keys()):
+            if key != '/Parent':
+                digest.update(key.encode())
+                hash_object(obj[key], digest, seen)
+    elif isinstance(obj, Array):
+        digest.update(b'[')
+        for item in obj:
+            hash_object(item, digest, seen)
+        digest.update(b']')
+    elif isinstance(obj, String):
+        digest.update(bytes(obj))
+    else:
+        digest.update(str(obj).encode())
+
+def hash_drawing(content, resources, digest, seen):
+    # the xobjects and fonts a page or form draws with, forms with what they
+    # draw in turn. resources that are listed but never used don't count
+    for operands, operator in parse_content_stream(content, 'Do Tf'):
+        category = '/XObject' if str(operator) == 'Do' else '/Font'
+        obj = resources.get(category, {}).get(operands[0]) if resources is not None else None
+        if obj is None or (obj.is_indirect and obj.objgen in seen):
+            continue
+        if isinstance(obj, Stream) and obj.get('/Subtype') == Name.Form:
+            seen.add(obj.objgen)
+            digest.update(obj.read_raw_bytes())
+            hash_drawing(obj, obj.get('/Resources', resources), digest, seen)
+        else:
+            hash_object(obj, digest, seen)
+
+def get_page_hash(page, page_image: PdfImage | None) -> str:
+    # pages without a scan are hashed by their content streams and whatever
+    # they draw: images (also inside forms), fonts and forms themselves
+    if page_image is not None:
+        return get_image_hash(page_image)
+    digest = hashlib.sha256()
+    contents = page.obj.get('/Contents')
+    streams = contents if isinstance(contents, Array) else [contents] if contents is not None else []
+    for stream in streams:
+        digest.update(stream.read_raw_bytes())
+    hash_drawing(page, page.obj.get('/Resources'), digest, set())
+    return digest.hexdigest()
+
+def get_page_hashes(pdf_path) -> dict[int, str]:
     with Pdf.open(pdf_path) as pdf:
-        with pdf.open_metadata() as meta:
-            uuid = meta.get('lsma:UUID')
-            url = meta.get('lsma:URL')
-            downloaded_at = meta.get('lsma:Downloaded_at')
-            if uuid:
-                uuid = UUID(hex=uuid)
-            if downloaded_at:
-                downloaded_at = datetime.fromisoformat(downloaded_at)
-            return uuid, url, downloaded_at
-
-
-def extract_images(pdf_path, original_folder):
-    pdf = Pdf.open(pdf_path)
+        hashes = {}
+        for i, page in enumerate(pdf.pages, start=1):
+            page_image = get_page_image(page)
+            if not is_google_cover(i, page_image):
+                hashes[i] = get_page_hash(page, page_image)
+        return hashes
+
+def get_fingerprint(hashes: dict[int, str]) -> str:
+    # the same scan gets the same fingerprint whatever metadata was added to the file
+    return hashlib.sha256(' '.join(hashes[number] for number in sorted(hashes)).encode()).hexdigest()
+
+def find_duplicates(hashes: dict[int, str], uuid=None, near_threshold=0.8):
+    # returns the book that is exactly the same scan, if there is one, and
+    # the book sharing the most page images with it if they share at least
+    # near_threshold of its pages (e.g. the same scan with another cover page)
+    books = Book.objects.all()
+    pages = Page.objects.filter(image_hash__in=set(hashes.values()))
+    if uuid:
+        books = books.exclude(uuid=uuid)
+        pages = pages.exclude(book__uuid=uuid)
+    exact = books.filter(fingerprint=get_fingerprint(hashes)).first()
+    if exact or not hashes:
+        return exact, None
+    shared = (pages
+        .values('book')
+        .annotate(shared=Count('image_hash', distinct=True))
+        .order_by('-shared')
+        .first())
+    if shared and shared['shared'] >= near_threshold * len(hashes):
+        return None, Book.objects.get(pk=shared['book'])
+    return None, None
+
+class ExtractedPage(NamedTuple):
+    # a page image on its way to ocr. records and version are already filled
+    # in for pages that don't need ocr, from the pdf's text layer or because
+    # the page is blank. number is the page of the pdf, half is set when it
+    # was a spread split into two pages
+    number: int
+    original_image: Path
+    image: Image.Image
+    image_hash: str
+    records: list[BoxRecord] | None = None
+    version: str | None = None
+    kinds: list[str] | None = None
+    half: str | None = None
+
+
+def extract_images(pdf_path, original_folder, metrics, skip=()):
+    # yields an ExtractedPage at a time so the caller can start on a page
+    # while the rest of the pdf is still being extracted. pages whose number
+    # is in skip aren't decoded at all
+    with metrics.stage('parse'):
+        pdf = Pdf.open(pdf_path)
+        document = open_document(pdf_path)
     if not original_folder.exists():
         original_folder.mkdir()
-    for i, page in enumerate(pdf.pages, start=1):
-        print(f'extracting image from page {i} of {len(pdf.pages)} in {pdf_path}')
-        xobject = page['/Resources']['/XObject']
-        images = []
-        for image in xobject.items():
+    try:
+        for i, page in enumerate(pdf.pages, start=1):
+            if i in skip:
+                continue
+            print(f'extracting image from page {i} of {len(pdf.pages)} in {pdf_path}')
+            with metrics.stage('parse', i):
+                page_image = get_page_image(page)
+            if is_google_cover(i, page_image):
+                print(f'skipping google first page for {pdf_path}')
+                continue
+            if page_image is not None:
+                filename, image = save_image(page_image, original_folder / str(i), metrics, i)
+            elif document is not None:
+                filename, image = save_rendered_page(document, i, original_folder / str(i), metrics)
+            else:
+                raise ValueError(f'Page {i} has no image, pypdfium2 is needed to render it')
+            with metrics.stage('hash', i):
+                image_hash = get_page_hash(page, page_image)
+            gutter = None
+            if settings.SPLIT_SPREADS:
+                with metrics.stage('split', i):
+                    gutter = find_gutter(image)
+            if gutter:
+                print(f'splitting page {i} of {pdf_path} at x={gutter}')
+                metrics.count('split_pages', 1, i)
+                halves = save_halves(image, gutter, filename, metrics, i)
+            else:
+                halves = [(None, filename, image)]
+            for half, filename, image in halves:
+                extracted = ExtractedPage(i, filename, image, image_hash, half=half)
+                # the text layer of a spread runs across the fold, the
+                # halves are ocred instead
+                use_text_layer = settings.VECTOR_TEXT and (page_image is None or settings.VECTOR_TEXT_ON_SCANS)
+                if half is None and document is not None and use_text_layer:
+                    with metrics.stage('text_layer', i):
+                        text_records = get_text_records(document, i, image.size, rendered=page_image is None)
+                    if text_records is not None:
+                        metrics.count('text_layer_pages', 1, i)
+                        extracted = extracted._replace(records=text_records, version=text_layer_version())
+                if extracted.records is None and settings.SKIP_BLANK_PAGES:
+                    with metrics.stage('classify', i):
+                        kind = classify_page(image)
+                    if kind:
+                        metrics.count('skipped_pages', 1, i)
+                        # tesseract finds nothing but the page box on pages like these
+                        page_box = BoxRecord(Box.Level.PAGE, 1, 0, 0, 0, 0, 0, 0, *image.size, None, '')
+                        extracted = extracted._replace(records=[page_box], version=classifier_version, kinds=[kind])
+                yield extracted
+    finally:
+        pdf.close()
+        if document is not None:
+            document.close()
+
+def save_image(page_image: PdfImage, fileprefix: Path, metrics, number) -> tuple[Path, Image.Image]:
+    # decodes the pdf image once, the decoded image goes to ocr and only the
+    # archival copy is written to disk. jpegs are copied out of the pdf
+    # as they are, everything else (mostly jpeg 2000) is stored as png
+    with metrics.stage('decode', number):
+        image = page_image.as_pil_image()
+    with metrics.stage('encode', number):
+        if page_image.filters == ['/DCTDecode']:
+            filename = Path(page_image.extract_to(fileprefix=str(fileprefix)))
+        else:
+            filename = fileprefix.with_suffix('.png')
+            image.save(filename)
+    metrics.count('image_bytes', filename.stat().st_size, number)
+    metrics.count('pixels', image.width * image.height, number)
+    return filename, image
+
+def save_rendered_page(document, number, fileprefix: Path, metrics) -> tuple[Path, Image.Image]:
+    with metrics.stage('render', number):
+        image = render_page(document, number)
+    filename = fileprefix.with_suffix('.png')
+    with metrics.stage('encode', number):
+        image.save(filename)
+    metrics.count('image_bytes', filename.stat().st_size, number)
+    metrics.count('pixels', image.width * image.height, number)
+    return filename, image
+
+def save_halves(image: Image.Image, gutter, filename: Path, metrics, number) -> list[tuple[str, Path, Image.Image]]:
+    # each half of a spread is stored as a page image of its own in place
+    # of the whole spread
+    halves = []
+    with metrics.stage('encode', number):
+        for half, half_image in split_spread(image, gutter):
+            half_filename = filename.with_name(f'{number}{half}.png')
+            half_image.save(half_filename)
+            halves.append((half, half_filename, half_image))
+        filename.unlink()
+    return halves
+
+def renumber_pages(book):
+    # page numbers follow the pdf, with every split spread before a page
+    # pushing it back by one. books without spreads keep number equal to
+    # pdf_page_number
+    table = connection.ops.quote_name(Page._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f'''
+            UPDATE {table} SET number = numbered.number
+            FROM (
+                SELECT id, pdf_page_number + count(*) FILTER (WHERE spread_half = %s)
+                    OVER (ORDER BY pdf_page_number, spread_half NULLS FIRST) AS number
+                FROM {table} WHERE book_id = %s
+            ) AS numbered
+            WHERE {table}.id = numbered.id AND {table}.number IS DISTINCT FROM numbered.number
+        ''', [Page.Half.RIGHT, book.pk])
+
+def update_has_vector_text(book):
+    book.has_vector_text = book.pages.filter(ocr_version__startswith=text_layer_prefix).exists()
+    book.save(update_fields=['has_vector_text'])
+
+def iter_in_thread(iterable, maxsize):
+    # runs iterable in a background thread, never more than maxsize items
+    # ahead of the consumer
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # gives up once the consumer has stopped, it may never take another item
+        while not stop.is_set():
             try:
-                images.append(PdfImage(image[1]))
-            except TypeError:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
-        images.sort(key=lambda x: x.height)
-        page_image = images[-1]
-        if i==1 and page_image.height == 750 and page_image.width == 1800:
-            print(f'skipping google first page for {pdf_path}')
-            continue
-        filename = images[-1].extract_to(fileprefix=f'{original_folder}/{i}')
-    pdf.close()
-
-def convert_images(folder: Path):
-    jpg2000_images = folder.glob('*.jp2')
-    if jpg2000_images:
-        jp2_folder = folder / 'jp2'
-        jp2_folder.mkdir(exist_ok=True)
-    for image in jpg2000_images:
-        print(f'converting {image} to .png')
-        moved_image = image.rename(jp2_folder/image.name)
-        im = Image.open(moved_image)
-        im.save(moved_image.parents[1]/f'{moved_image.stem}.png')
-
-def get_boxes(image_path: str) -> list[list]:
-    print(f'recognizing text in {image_path}')
-    data = pytesseract.image_to_data(Image.open(image_path))
-    data = data.split('\n')
-    if data[-1] == '':
-        del data[-1]
-    data = [line.split('\t') for line in data[1:]]
-    return data
-
-def get_stem(path):
-    return int(path.stem)
-
-def add_book(pdf_path):
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+class UnfinishedImport(ValueError):
+    pass
+
+class DuplicateBook(ValueError):
+    pass
+
+class ImportInProgress(Exception):
+    # not a ValueError, the import can go ahead once the other one is done
+    pass
+
+@contextmanager
+def claim_import(uuid):
+    # only one import of a book at a time, whichever process started it. a
+    # session level advisory lock outlasts the commits of a resumable import
+    # and goes away with the connection if the process dies
+    key = int.from_bytes(UUID(str(uuid)).bytes[:8], 'big', signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [key])
+        if not cursor.fetchone()[0]:
+            raise ImportInProgress(f'{uuid} is being imported by another process')
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [key])
+
+def add_book(pdf_path, ocr_workers=1, resumable=False, progress=None):
+    # by default the whole book is one transaction. a resumable import commits
+    # pages as it goes instead, and when it is run again for a book that
+    # never finished it carries on after the last committed page
     print(f'Adding {pdf_path}')
     uuid, url, downloaded_at = get_metadata(pdf_path)
+    original_image_dir = Path(f'original_page_images/{str(uuid)[:8]}')
+    with claim_import(uuid), nullcontext() if resumable else transaction.atomic():
+        book = Book.objects.filter(uuid=uuid).first()
+        if book and book.imported_at:
+            raise ValueError('This book is already in the db')
+        if book and not resumable:
+            raise UnfinishedImport('This book has an unfinished import')
+        if book:
+            done = set(book.pages.values_list('pdf_page_number', flat=True))
+            print(f'Resuming book {url} after {len(done)} pages')
+        else:
+            # checked before anything is extracted so duplicates cost no ocr
+            hashes = get_page_hashes(pdf_path)
+            duplicate, near_duplicate = find_duplicates(hashes, uuid)
+            if duplicate:
+                raise DuplicateBook(f'This scan is already in the db as {duplicate.uuid}')
+            if near_duplicate:
+                print(f'{pdf_path} shares most of its pages with {near_duplicate.uuid}, flagging it as a possible duplicate')
+            try:
+                book = Book.objects.create(
+                    uuid=uuid,
+                    url=url,
+                    downloaded_at=downloaded_at,
+                    fingerprint=get_fingerprint(hashes),
+                    possible_duplicate_of=near_duplicate,
+                )
+            except IntegrityError:
+                raise ValueError('This book is already in the db')
+            done = set()
+            print(f'Added book {url}')
+
+        try:
+            add_pages(book, pdf_path, original_image_dir, ocr_workers, skip=done, progress=progress)
+        except BaseException:
+            # the db rows roll back with the transaction, the images have to go by hand
+            if not resumable:
+                shutil.rmtree(original_image_dir, ignore_errors=True)
+            raise
+        renumber_pages(book)
+        update_has_vector_text(book)
+        book.imported_at = datetime.now(timezone.utc)
+        book.save(update_fields=['imported_at'])
+    if cache := get_cache():
+        cache.trim()
+
+def add_pages(book, pdf_path, original_image_dir, ocr_workers=1, queue_size=4, skip=(), existing=None, progress=None):
+    # three stages run at the same time: a thread extracts and converts page
+    # images, worker processes run tesseract and this process writes to the
+    # db in page order. queue_size bounds how far each stage can get ahead of
+    # the next, so memory use doesn't grow with the size of the book.
+    # pages whose (number, half) is in existing are rewritten in place and
+    # taken out of it. progress is
+    # called with the fraction of the pdf done after each page. pages with a
+    # text layer or that look blank skip tesseract
+    executor = ocr_pool(ocr_workers)
+    metrics = IngestMetrics(book, pdf_path)
+    loader = PageLoader(metrics=metrics)
+    ocr_version = engine_version()
+    existing = existing or {}
+    in_flight = deque()
+    if progress:
+        with Pdf.open(pdf_path) as pdf:
+            page_count = len(pdf.pages)
+
+    def add_next_page():
+        extracted, future, version = in_flight.popleft()
+        number = extracted.number
+        with metrics.stage('ocr_wait', number):
+            (records, rotation), ocr_seconds = future.result()
+        metrics.add_time('ocr', ocr_seconds, number)
+        metrics.count('boxes', len(records), number)
+        add_page(book, loader, extracted, records, version, existing.pop((number, extracted.half), None), rotation)
+        metrics.finish_page(number)
+        if progress:
+            progress(number / page_count)
+
     try:
-        book = Book.objects.create(uuid=uuid, url=url, downloaded_at=downloaded_at)
-    except IntegrityError:
-        raise ValueError('This book is already in the db')
-    print(f'Added book {url}')
+        pages = extract_images(pdf_path, original_image_dir, metrics, skip=skip)
+        for extracted in iter_in_thread(pages, queue_size):
+            if extracted.records is None:
+                print(f'recognizing text in {extracted.original_image}')
+                in_flight.append((extracted, executor.submit(timed, get_page_boxes, extracted.image), ocr_version))
+            else:
+                print(f'no ocr needed for {extracted.original_image} ({extracted.version})')
+                future = Future()
+                future.set_result(((extracted.records, None), 0))
+                in_flight.append((extracted, future, extracted.version))
+            if len(in_flight) >= ocr_workers + queue_size:
+                add_next_page()
+        while in_flight:
+            add_next_page()
+        loader.flush()
+        metrics.finish()
+    finally:
+        executor.shutdown(cancel_futures=True)
 
+def add_page(book, loader, extracted, records, ocr_version, page=None, rotation=None):
+    print(f'adding {extracted.original_image} to db')
+    words = [record.text for record in records if record.level == Box.Level.WORD]
+    if page is None:
+        # the final number is set by renumber_pages once the book is in
+        page = Page(book=book, number=extracted.number)
+    elif page.original_image.name != str(extracted.original_image):
+        transaction.on_commit(partial(Path(page.original_image.name).unlink, missing_ok=True))
+    page.pdf_page_number = extracted.number
+    page.spread_half = extracted.half
+    page.original_image = str(extracted.original_image)
+    page.width, page.height = extracted.image.size
+    page.search_text = word_list_to_text(words)
+    page.image_hash = extracted.image_hash
+    if page.ocr_version.startswith(classifier_prefix) and page.kinds:
+        # what an older classifier said about the page is redone too
+        page.kinds = [kind for kind in page.kinds if kind not in (Page.Kind.BLANK, Page.Kind.DECORATIVE_PAPER)] or None
+    page.ocr_version = ocr_version
+    if extracted.kinds:
+        page.kinds = sorted(set(page.kinds or []) | set(extracted.kinds))
+    if rotation:
+        # the stored image stays as scanned, the boxes are in its coordinates
+        page.text_rotation = rotation
+        page.image_problems = sorted(set(page.image_problems or []) | {Page.ImageProblem.ROTATION})
+    # the halves of a spread are written together, a resumed import
+    # skips pdf pages that are in the db
+    loader.add(page, records, keep_open=extracted.half == Page.Half.LEFT)
+
+def import_book(pdf_path, ocr_workers=1, resumable=False):
+    try:
+        add_book(pdf_path, ocr_workers=ocr_workers, resumable=resumable)
+        return pdf_path, None
+    except Exception as e:
+        return pdf_path, f'{type(e).__name__}: {e}'
+    finally:
+        connections.close_all()
+
+def import_books(pdf_paths, workers, ocr_workers=1, resumable=False):
+    # one book per worker process, each in its own transaction. returns
+    # (pdf_path, error) tuples, error is None for books that were imported.
+    # the workers are forked, they must not share this process's connection
+    connections.close_all()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(import_book, pdf_path, ocr_workers, resumable) for pdf_path in pdf_paths]
+        for future in as_completed(futures):
+            pdf_path, error = future.result()
+            if error:
+                print(f'failed to import {pdf_path}: {error}')
+            else:
+                print(f'imported {pdf_path}')
+            results.append((pdf_path, error))
+    return results
+
+def update_book(pdf_path, ocr_workers=1, progress=None):
+    # reimports only the pages whose image or ocr config changed. pages are
+    # matched to the pdf by image hash, so a page inserted or removed earlier
+    # in the pdf doesn't make every page after it look changed: unchanged
+    # pages keep their Page row, boxes, edits, fixes, sections and graphics
+    # and only move to their new place. changed pages keep their Page row
+    # but get new boxes. image files of pages that moved are renamed, a
+    # failed update puts them back
+    renamed = []
+    try:
+        with transaction.atomic():
+            update_pages(pdf_path, ocr_workers, progress, renamed)
+    except BaseException:
+        for old, new in reversed(renamed):
+            new.rename(old)
+        raise
+
+def update_pages(pdf_path, ocr_workers, progress, renamed):
+    uuid, _, _ = get_metadata(pdf_path)
+    book = Book.objects.get(uuid=uuid)
+    original_image_dir = Path(f'original_page_images/{str(uuid)[:8]}')
+    ocr_version = engine_version()
+    # pages read from the text layer, classified as blank or improved by
+    # reocr_low_confidence are only redone when their image changes
+    versions = {ocr_version, text_layer_version(), classifier_version, *profile_versions()}
+    hashes = get_page_hashes(pdf_path)
+    # pdf page number -> its pages, two for a split spread
+    existing = {}
+    for page in book.pages.all():
+        existing.setdefault(page.pdf_page_number, []).append(page)
+
+    unhashed = []
+    for number, pages in existing.items():
+        for page in pages:
+            if not page.image_hash and number in hashes:
+                # imported before pages were hashed, assume the image is the same
+                page.image_hash = hashes[number]
+                page.ocr_version = ocr_version
+                unhashed.append(page)
+    Page.objects.bulk_update(unhashed, ['image_hash', 'ocr_version'])
+    book.fingerprint = get_fingerprint(hashes)
+    book.save(update_fields=['fingerprint'])
+
+    # pdf page number now -> pdf page number in the db. a page stays where it
+    # is if its image still is, pages with the same image (e.g. blank pages
+    # saved the same way) are matched in order
+    matches = {number: number for number, image_hash in hashes.items()
+               if number in existing and existing[number][0].image_hash == image_hash}
+    by_hash = {}
+    for number in sorted(existing.keys() - set(matches.values()), key=lambda number: number or 0):
+        by_hash.setdefault(existing[number][0].image_hash, []).append(number)
+    for number in sorted(hashes.keys() - matches.keys()):
+        if by_hash.get(hashes[number]):
+            matches[number] = by_hash[hashes[number]].pop(0)
+    unchanged = {number for number, old in matches.items() if all(page.ocr_version in versions for page in existing[old])}
+    moves = {page: number for number, old in matches.items() if number != old for page in existing[old]}
+    # pages matched by image but with an old ocr config are redone in their
+    # new place. a page whose image matches nothing takes over the pages
+    # that were at its number, if their images went nowhere else
+    changed_at = {number: existing[old] for number, old in matches.items() if number not in unchanged}
+    for number in hashes.keys() - matches.keys():
+        if number in existing and number not in matches.values():
+            changed_at[number] = existing[number]
+    kept = set(matches.values()) | (changed_at.keys() - matches.keys())
+    removed = [page for number, pages in existing.items() if number not in kept for page in pages]
+    new = hashes.keys() - matches.keys() - changed_at.keys()
+    print(f'{len(unchanged)} pages unchanged ({len(set(moves.values()) & unchanged)} of them moved), '
+          f'{len(changed_at)} changed, {len(new)} new, {len(removed)} removed in {pdf_path}')
+
+    move_pages(moves, removed, renamed)
+    changed = {(number, page.spread_half): page for number, pages in changed_at.items() for page in pages}
+    add_pages(book, pdf_path, original_image_dir, ocr_workers, skip=unchanged, existing=changed, progress=progress)
+    # what is left of changed are spreads that are no longer split or pages
+    # that are split now, whatever referred to them moves to what replaced them
+    leftover = []
+    for page in changed.values():
+        replacements = list(book.pages.filter(pdf_page_number=page.pdf_page_number)
+                            .exclude(pk__in=[old.pk for old in changed.values()])
+                            .order_by('spread_half'))
+        if replacements:
+            move_page_references(page, replacements)
+            leftover.append(page)
+        else:
+            removed.append(page)
+    for page in removed:
+        if has_references(page):
+            print(f'keeping {page} of {book}, it is gone from {pdf_path} but sections, graphics or '
+                  f'the book still refer to it. move them and delete it by hand')
+            continue
+        delete_page(page)
+    for page in leftover:
+        delete_page(page)
+    renumber_pages(book)
+    update_has_vector_text(book)
+
+def move_pages(moves, removed, renamed):
+    # gives pages their new pdf page number, {page: number}, and renames
+    # their images to match, so the pages extracted into their old places
+    # don't overwrite them. a removed page in the way gets a name of its own.
+    # files go through a temporary name first so pages can trade places,
+    # every rename is added to renamed as (old, new)
+    names = {}
+    for page, number in moves.items():
+        path = Path(page.original_image.name)
+        names[page] = path.with_name(f'{number}{page.spread_half or ""}{path.suffix}')
+        page.pdf_page_number = number
+    taken = set(names.values())
+    for page in removed:
+        path = Path(page.original_image.name)
+        if path in taken:
+            names[page] = path.with_name(f'removed-{page.pk}-{path.name}')
+    pages = list(names)
+    for step in ('temporary', 'final'):
+        for page in pages:
+            path = Path(page.original_image.name)
+            new_path = names[page].with_name(f'{names[page].name}.moving') if step == 'temporary' else names[page]
+            if path.exists():
+                path.rename(new_path)
+                renamed.append((path, new_path))
+            page.original_image = str(new_path)
+        Page.objects.bulk_update(pages, ['original_image', 'pdf_page_number'])
+
+def delete_page(page):
+    transaction.on_commit(partial(Path(page.original_image.name).unlink, missing_ok=True))
+    page.delete()
+
+def has_references(page) -> bool:
+    return (page.section_headings.exists() or page.sections.exists() or page.graphics.exists()
+            or Book.objects.filter(Q(title_page=page) | Q(copyright_page=page) | Q(printing_info_page=page)).exists())
+
+def move_page_references(page, replacements):
+    # from a page to the halves it was split into (in reading order), or
+    # from a half to the whole page it is part of again
+    first = replacements[0]
+    Section.objects.filter(heading_page=page).update(heading_page=first)
+    for section in page.sections.all():
+        section.pages.add(*replacements)
+    for field in ('title_page', 'copyright_page', 'printing_info_page'):
+        Book.objects.filter(**{field: page}).update(**{field: first})
+    # graphics keep their place on the scan. the right half starts where
+    # the left half ends
+    if page.spread_half == Page.Half.RIGHT:
+        offset = first.width - page.width
+    else:
+        offset = 0
+    for graphic in page.graphics.all():
+        graphic.page = first
+        if graphic.left is not None:
+            left = graphic.left + offset
+            if len(replacements) > 1 and left >= first.width:
+                graphic.page = replacements[1]
+                left -= first.width
+            shift = left - graphic.left
+            graphic.left = left
+            if graphic.left_with_text is not None:
+                graphic.left_with_text = max(graphic.left_with_text + shift, 0)
+        graphic.save()
+
+def reimport_book(pdf_path, ocr_workers=1, progress=None):
+    # throws away everything about the book and imports it from scratch. the
+    # old book and its images stay until the new import commits, a failed
+    # reimport leaves the book as it was
+    uuid, _, _ = get_metadata(pdf_path)
     original_image_dir = Path(f'original_page_images/{str(uuid)[:8]}')
-    extract_images(pdf_path, original_image_dir)
-    convert_images(original_image_dir)
-
-    original_images = sorted(original_image_dir.glob('*.*'), key=get_stem)
-
-    for original_image in original_images:
-        print(f'adding {original_image} to db')
-        page = Page.objects.create(book=book, original_image=str(original_image), number=int(original_image.stem))
-        box_lists = get_boxes(original_image)
-        for i, box_list in enumerate(box_lists, start=1):
-            box_list.append(i)
-            if box_list[10] == -1:
-                box_list[10] = None
-
-        page_lists = [Box(
-            page=page,
-            order=box_list[12],
-            level=box_list[0],
-            page_number=box_list[1],
-            block_number=box_list[2],
-            paragraph_number=box_list[3],
-            line_number=box_list[4],
-            word_number=box_list[5],
-            left=box_list[6],
-            top=box_list[7],
-            width=box_list[8],
-            height=box_list[9],
-            original_confidence=box_list[10],
-            text=box_list[11],
-            original_text=box_list[11],
-            ) for box_list in box_lists if box_list[0]=='1']
-        Box.objects.bulk_create(page_lists)
-
-        block_lists = [Box(
-            page=page,
-            parent=page_lists[int(box_list[1])-1],
-            order=box_list[12],
-            level=box_list[0],
-            page_number=box_list[1],
-            block_number=box_list[2],
-            paragraph_number=box_list[3],
-            line_number=box_list[4],
-            word_number=box_list[5],
-            left=box_list[6],
-            top=box_list[7],
-            width=box_list[8],
-            height=box_list[9],
-            original_confidence=box_list[10],
-            text=box_list[11],
-            original_text=box_list[11],
-            ) for box_list in box_lists if box_list[0]=='2']
-        Box.objects.bulk_create(block_lists)
-
-        paragraph_lists = [Box(
-            page=page,
-            parent=block_lists[int(box_list[2])-1],
-            order=box_list[12],
-            level=box_list[0],
-            page_number=box_list[1],
-            block_number=box_list[2],
-            paragraph_number=box_list[3],
-            line_number=box_list[4],
-            word_number=box_list[5],
-            left=box_list[6],
-            top=box_list[7],
-            width=box_list[8],
-            height=box_list[9],
-            original_confidence=box_list[10],
-            text=box_list[11],
-            original_text=box_list[11],
-            ) for box_list in box_lists if box_list[0]=='3']
-        Box.objects.bulk_create(paragraph_lists)
-
-        line_lists = [Box(
-            page=page,
-            parent=paragraph_lists[int(box_list[3])-1],
-            order=box_list[12],
-            level=box_list[0],
-            page_number=box_list[1],
-            block_number=box_list[2],
-            paragraph_number=box_list[3],
-            line_number=box_list[4],
-            word_number=box_list[5],
-            left=box_list[6],
-            top=box_list[7],
-            width=box_list[8],
-            height=box_list[9],
-            original_confidence=box_list[10],
-            text=box_list[11],
-            original_text=box_list[11],
-            ) for box_list in box_lists if box_list[0]=='4']
-        Box.objects.bulk_create(line_lists)
-
-        word_lists = [Box(
-            page=page,
-            parent=line_lists[int(box_list[4])-1],
-            order=box_list[12],
-            level=box_list[0],
-            page_number=box_list[1],
-            block_number=box_list[2],
-            paragraph_number=box_list[3],
-            line_number=box_list[4],
-            word_number=box_list[5],
-            left=box_list[6],
-            top=box_list[7],
-            width=box_list[8],
-            height=box_list[9],
-            original_confidence=box_list[10],
-            text=box_list[11],
-            original_text=box_list[11],
-            ) for box_list in box_lists if box_list[0]=='5']
-        Box.objects.bulk_create(word_lists)
-        page.generate_text()
+    old_image_dir = original_image_dir.with_name(f'{original_image_dir.name}.old')
+    shutil.rmtree(old_image_dir, ignore_errors=True)
+    if original_image_dir.exists():
+        original_image_dir.rename(old_image_dir)
+    try:
+        with transaction.atomic():
+            print(f'removing {pdf_path}')
+            remove_book(uuid)
+            add_book(pdf_path, ocr_workers=ocr_workers, progress=progress)
+            print(f'deleting previously extracted images for {pdf_path}')
+            transaction.on_commit(partial(shutil.rmtree, old_image_dir, ignore_errors=True))
+    except BaseException:
+        shutil.rmtree(original_image_dir, ignore_errors=True)
+        if old_image_dir.exists():
+            old_image_dir.rename(original_image_dir)
+        raise
 
 def remove_book(uuid):
     book = Book.objects.get(uuid=str(uuid))
     book.delete()
-
-def download_url(url: str, new_name: Path) -> None:
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(new_name, 'wb') as f:
-            for chunk in r.iter_content(chunk_size = 16*1024):
-                f.write(chunk)
@@ -0,0 +1,153 @@
+from django.conf import settings
+from PIL import Image
+import math
+import numpy as np
+
+
+def get_config() -> dict:
+    return {
+        'x_height': settings.OCR_X_HEIGHT,
+        'binarize': settings.OCR_BINARIZE,
+        'deskew': settings.OCR_DESKEW,
+        'crop': settings.OCR_CROP_MARGINS,
+        'upscale': False,
+    }
+
+def config_version(config=None) -> str:
+    # part of the engine version, so changing the preprocessing counts as a
+    # new ocr config for the cache and for incremental reimports
+    config = config or get_config()
+    parts = [f'xh{config["x_height"]}' if config['x_height'] else '']
+    parts += [name for name in ('binarize', 'deskew', 'crop', 'upscale') if config.get(name)]
+    return '+'.join(part for part in parts if part)
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * weight / total - mean) ** 2 / (weight * (total - weight))
+    # nan everywhere for an image with a single shade
+    return int(np.argmax(np.nan_to_num(between)))
+
+def get_crop(ink: np.ndarray, padding=0.01) -> tuple[int, int, int, int]:
+    # (left, top, right, bottom) around the ink. rows and columns that are
+    # nearly all ink are scanner borders and don't count
+    rows = ink.mean(axis=1)
+    columns = ink.mean(axis=0)
+    rows_with_ink = np.flatnonzero((rows > 0.002) & (rows < 0.9))
+    columns_with_ink = np.flatnonzero((columns > 0.002) & (columns < 0.9))
+    height, width = ink.shape
+    if not len(rows_with_ink) or not len(columns_with_ink):
+        return 0, 0, width, height
+    pad = round(padding * max(width, height))
+    return (int(max(columns_with_ink[0] - pad, 0)), int(max(rows_with_ink[0] - pad, 0)),
+            int(min(columns_with_ink[-1] + pad + 1, width)), int(min(rows_with_ink[-1] + pad + 1, height)))
+
+def get_x_height(ink: np.ndarray) -> float | None:
+    # the lines of text are runs of rows with ink in them. within a line the
+    # rows between the baseline and the x-height hold most of the ink, so
+    # the x-height is the number of rows with more than half the line's
+    # densest row
+    profile = ink.sum(axis=1)
+    has_ink = profile > 0.01 * ink.shape[1]
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], has_ink.astype(np.int8), [0]))))
+    heights = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        line = profile[start:end]
+        if end - start >= 4:
+            heights.append(np.count_nonzero(line > 0.5 * line.max()))
+    return float(np.median(heights)) if heights else None
+
+def get_skew(ink: np.ndarray, max_angle=3.0, step=0.1, max_size=1000) -> float:
+    # the angle in degrees that lines up the text rows best, found by
+    # shearing the ink coordinates and looking for the sharpest row profile
+    factor = max(1, math.ceil(max(ink.shape) / max_size))
+    small = ink[::factor, ::factor]
+    ys, xs = np.nonzero(small)
+    if len(ys) < 100:
+        return 0.0
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    slopes = np.tan(np.radians(angles))
+    # one row of sheared y coordinates per candidate angle
+    sheared = np.rint(ys[None, :] - xs[None, :] * slopes[:, None]).astype(np.int64)
+    offset = sheared.min()
+    rows = sheared.max() - offset + 1
+    flat = (sheared - offset) + np.arange(len(angles))[:, None] * rows
+    profiles = np.bincount(flat.ravel(), minlength=len(angles) * rows).reshape(len(angles), rows)
+    scores = (profiles.astype(np.float64) ** 2).sum(axis=1)
+    return round(float(angles[np.argmax(scores)]), 2)
+
+
+class Transform:
+    # how a preprocessed image relates to the original: cropped at offset,
+    # rotated by angle degrees counterclockwise about the middle of the crop,
+    # then scaled. maps ocr box records from the preprocessed image back
+    def __init__(self, original_size, offset=(0, 0), crop_size=None, angle=0.0, scale=1.0):
+        self.original_size = original_size
+        self.offset = offset
+        self.crop_size = crop_size or original_size
+        self.angle = angle
+        self.scale = scale
+
+    def to_original(self, record):
+        if record.level == 1:
+            # the page box stays the whole page
+            return record._replace(left=0, top=0, width=self.original_size[0], height=self.original_size[1])
+        left, top = record.left / self.scale, record.top / self.scale
+        right, bottom = left + record.width / self.scale, top + record.height / self.scale
+        corners = [(left, top), (right, top), (left, bottom), (right, bottom)]
+        if self.angle:
+            center_x, center_y = self.crop_size[0] / 2, self.crop_size[1] / 2
+            cos, sin = math.cos(math.radians(self.angle)), math.sin(math.radians(self.angle))
+            corners = [(center_x + (x - center_x) * cos - (y - center_y) * sin,
+                        center_y + (x - center_x) * sin + (y - center_y) * cos) for x, y in corners]
+        xs = [x + self.offset[0] for x, _ in corners]
+        ys = [y + self.offset[1] for _, y in corners]
+        left, top = max(round(min(xs)), 0), max(round(min(ys)), 0)
+        right, bottom = min(round(max(xs)), self.original_size[0]), min(round(max(ys)), self.original_size[1])
+        return record._replace(left=left, top=top, width=max(right - left, 0), height=max(bottom - top, 0))
+
+
+def preprocess(image: Image.Image, config=None) -> tuple[Image.Image, Transform]:
+    # crops the margins, straightens, scales the text to config['x_height']
+    # pixels (only down unless config['upscale']) and binarizes. scans with a dark background are
+    # inverted to dark text on white on the way
+    config = config or get_config()
+    gray = np.asarray(image.convert('L'))
+    threshold = otsu_threshold(gray)
+    ink = gray <= threshold
+    if ink.mean() > 0.5:
+        gray = 255 - gray
+        threshold = 254 - threshold
+        ink = ~ink
+    transform = Transform(image.size)
+
+    if config['crop']:
+        left, top, right, bottom = get_crop(ink)
+        gray, ink = gray[top:bottom, left:right], ink[top:bottom, left:right]
+        transform.offset = (left, top)
+        transform.crop_size = (right - left, bottom - top)
+    result = Image.fromarray(np.ascontiguousarray(gray))
+
+    if config['deskew']:
+        angle = get_skew(ink)
+        if angle:
+            # the pixels uncovered by the rotation are filled with background
+            result = result.rotate(angle, resample=Image.BILINEAR, fillcolor=255)
+            ink = np.asarray(result) <= threshold
+            transform.angle = angle
+
+    if config['x_height']:
+        x_height = get_x_height(ink)
+        if x_height and (x_height > config['x_height'] or config.get('upscale')):
+            scale = min(max(config['x_height'] / x_height, 0.25), 4)
+            size = (max(round(result.width * scale), 1), max(round(result.height * scale), 1))
+            result = result.resize(size, Image.LANCZOS)
+            transform.scale = scale
+
+    if config['binarize']:
+        result = Image.fromarray(np.where(np.asarray(result) <= threshold, 0, 255).astype(np.uint8))
+    return result, transform
@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+import multiprocessing
+import signal
+import threading
+
+from .models import Box, Page
+from .text import word_list_to_text
+
+
+def get_stale_pages(since=None):
+    # pages with word boxes changed after their text was generated and pages
+    # with words whose text never was. since only counts boxes changed after
+    # it, e.g. the start of an annotation session. boxes that were deleted
+    # leave nothing to go on, that needs a full rebuild
+    words = Box.objects.filter(page=OuterRef('pk'), level=Box.Level.WORD)
+    if since:
+        words = words.filter(modified__gt=since)
+    changed = words.filter(modified__gt=OuterRef('text_generated_at'))
+    return Page.objects.filter(Exists(changed) | (Q(text_generated_at__isnull=True) & Exists(words)))
+
+def iter_page_words(pages, batch_size=1000):
+    # the words of batch_size pages at a time as [(page_id, [word, ...]), ...].
+    # pages are walked in id order and each batch's words come from one query
+    # in (page_id, order) order, pages without words get an empty list
+    last_id = None
+    while True:
+        batch = pages.order_by('pk')
+        if last_id is not None:
+            batch = batch.filter(pk__gt=last_id)
+        ids = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        words = {page_id: [] for page_id in ids}
+        rows = (Box.objects
+            .filter(page_id__in=ids, level=Box.Level.WORD)
+            .order_by('page_id', 'order')
+            .values_list('page_id', 'text'))
+        for page_id, text in rows.iterator(chunk_size=10000):
+            words[page_id].append(text)
+        yield list(words.items())
+        last_id = ids[-1]
+
+def get_texts(page_words) -> list[tuple[int, str]]:
+    # runs in the worker processes
+    return [(page_id, word_list_to_text(words)) for page_id, words in page_words]
+
+def write_texts(texts, generated_at):
+    # generated_at is from before the words were read, a word edited while
+    # the text was being made leaves the page stale
+    Page.objects.bulk_update(
+        [Page(id=page_id, search_text=text, text_generated_at=generated_at) for page_id, text in texts],
+        ['search_text', 'text_generated_at'],
+    )
+
+def regenerate_text(pages=None, workers=1, batch_size=1000, progress=None) -> int:
+    # rebuilds search_text from the word boxes for pages (every page by
+    # default) without loading Page objects: the main process streams words
+    # and writes batches back with bulk_update while worker processes join
+    # the words into text. returns the number of pages
+    pages = Page.objects.all() if pages is None else pages
+    started = timezone.now()
+    count = pages.count()
+    done = 0
+    in_flight = deque()
+
+    def write_next():
+        nonlocal done
+        texts = in_flight.popleft().result()
+        write_texts(texts, started)
+        done += len(texts)
+        print(f'regenerated text for {done} of {count} pages')
+        if progress:
+            progress(done / count)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        for page_words in iter_page_words(pages, batch_size):
+            in_flight.append(executor.submit(get_texts, page_words))
+            # enough batches ahead to keep every worker busy while one is written
+            if len(in_flight) > workers + 1:
+                write_next()
+        while in_flight:
+            write_next()
+    return done
+
+def mark_text_dirty(page_id):
+    # called for every word box that is saved or deleted. the page is only
+    # dealt with once its transaction commits, once however many of its
+    # words changed. outside of a transaction that is straight away
+    connection = transaction.get_connection()
+    if not hasattr(connection, 'dirty_page_ids'):
+        connection.dirty_page_ids = set()
+    connection.dirty_page_ids.add(page_id)
+    transaction.on_commit(flush_dirty_pages)
+
+def flush_dirty_pages():
+    # every callback of a transaction after the first finds nothing left to
+    # do. ids left over from a rolled back transaction go along with the
+    # next commit, rebuilding their text does no harm
+    connection = transaction.get_connection()
+    page_ids, connection.dirty_page_ids = connection.dirty_page_ids, set()
+    if not page_ids:
+        return
+    if settings.PAGE_TEXT_AFTER_COMMIT:
+        started = timezone.now()
+        for page_words in iter_page_words(Page.objects.filter(id__in=page_ids)):
+            write_texts(get_texts(page_words), started)
+    else:
+        # one small update whatever the size of the page, flush_page_text
+        # rebuilds the text in the background
+        Page.objects.filter(id__in=page_ids).update(text_generated_at=None)
+
+def get_settled_pages(quiet=timedelta(seconds=30)):
+    # pages waiting for flush_page_text that have had no word edited for
+    # quiet, so a page being worked through is rebuilt once at the end
+    recent = Box.objects.filter(page=OuterRef('pk'), level=Box.Level.WORD, modified__gt=timezone.now() - quiet)
+    return Page.objects.filter(text_generated_at__isnull=True).exclude(Exists(recent))
+
+def flush_page_text(interval=10, quiet=timedelta(seconds=30), once=False, workers=1):
+    # rebuilds the text of pages with edited words until stopped. SIGINT or
+    # SIGTERM let the running batch finish first
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('stopping after the running batch finishes')
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    while not stop.is_set():
+        regenerate_text(get_settled_pages(quiet), workers)
+        if once:
+            break
+        stop.wait(interval)
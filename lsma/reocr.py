@@ -0,0 +1,94 @@
+from django.conf import settings
+from django.db.models import Aggregate, Avg, Exists, F, FloatField, OuterRef, Q
+
+from .loader import PageLoader
+from .models import Box, Page
+from .ocr import engine_version, get_page_boxes, ocr_pool, score, word_values
+from .preprocess import get_config
+from .text import word_list_to_text
+
+# heavier ocr settings tried on pages whose confidence is low. psm 4 reads
+# the page as one column of text of varying sizes, psm 6 as one uniform
+# block. both upscale small text instead of only shrinking big text
+profiles = [
+    {'psm': 4, 'x_height': 30},
+    {'psm': 6, 'x_height': 30},
+]
+
+
+class Percentile(Aggregate):
+    function = 'percentile_cont'
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=float(percentile), output_field=FloatField(), **extra)
+
+
+def get_preprocess_config(profile) -> dict:
+    return {**get_config(), 'x_height': profile['x_height'], 'upscale': True}
+
+def get_profile_version(profile) -> str:
+    return engine_version(psm=profile['psm'], tessdata_dir=settings.REOCR_TESSDATA_DIR or None,
+                          preprocess_config=get_preprocess_config(profile))
+
+def profile_versions() -> set[str]:
+    return {get_profile_version(profile) for profile in profiles}
+
+def get_low_confidence_pages(mean_below=75, percentile=0.1, percentile_below=30, books=None):
+    # pages whose mean word confidence or confidence at the given percentile
+    # is below the thresholds. pages a person has edited, confirmed or fixed
+    # anything on are left out, re-ocr would throw that work away
+    words = Q(boxes__level=Box.Level.WORD, boxes__original_confidence__isnull=False)
+    edited = Box.objects.filter(page=OuterRef('pk')).filter(
+        Q(confirmed_at__isnull=False) | ~Q(text=F('original_text')) | Q(ocr_fixes__isnull=False))
+    pages = Page.objects.all()
+    if books:
+        pages = pages.filter(book__uuid__in=books)
+    return (pages
+        .exclude(Exists(edited))
+        .annotate(
+            mean_confidence=Avg('boxes__original_confidence', filter=words),
+            low_confidence=Percentile('boxes__original_confidence', percentile, filter=words))
+        .filter(Q(mean_confidence__lt=mean_below) | Q(low_confidence__lt=percentile_below))
+        .order_by('mean_confidence'))
+
+def format_score(value) -> str:
+    return 'none' if value is None else f'{value:.1f}'
+
+def reocr_pages(pages, workers=1, min_gain=1.0, dry_run=False) -> int:
+    # runs every profile on every page and keeps the best scoring result if
+    # it beats what the page has now by min_gain. returns the number of pages
+    # that were improved
+    pages = list(pages)
+    tessdata_dir = settings.REOCR_TESSDATA_DIR or None
+    versions = [get_profile_version(profile) for profile in profiles]
+    pools = [ocr_pool(workers, psm=profile['psm'], tessdata_dir=tessdata_dir) for profile in profiles]
+    loader = PageLoader()
+    improved = 0
+    try:
+        futures = [
+            [pool.submit(get_page_boxes, page.original_image.name, True, get_preprocess_config(profile), page.text_rotation)
+             for pool, profile in zip(pools, profiles)]
+            for page in pages
+        ]
+        for page, page_futures in zip(pages, futures):
+            old_score = score(page.boxes.filter(level=Box.Level.WORD).values_list('original_confidence', 'original_text'))
+            results = []
+            for future, version in zip(page_futures, versions):
+                records, _ = future.result()
+                results.append((score(word_values(records)), records, version))
+            new_score, records, version = max(results, key=lambda result: -1 if result[0] is None else result[0])
+            if new_score is None or (old_score is not None and new_score < old_score + min_gain):
+                print(f'{page.book} {page}: kept {format_score(old_score)}, best retry {format_score(new_score)}')
+                continue
+            print(f'{page.book} {page}: {format_score(old_score)} -> {format_score(new_score)} with {version}')
+            improved += 1
+            if not dry_run:
+                page.search_text = word_list_to_text([text for _, text in word_values(records)])
+                page.ocr_version = version
+                loader.add(page, records)
+        loader.flush()
+    finally:
+        for pool in pools:
+            pool.shutdown(cancel_futures=True)
+    return improved
@@ -0,0 +1,57 @@
+from PIL import Image
+import numpy as np
+
+from .models import Page
+from .preprocess import otsu_threshold
+
+# pages are shrunk to this many pixels on their longest side to look for a gutter
+sample_size = 1000
+# a spread is at least this much wider than it is tall
+min_aspect = 1.2
+# the gutter is looked for in this middle part of the width
+search_band = (0.35, 0.65)
+
+
+def smooth(profile: np.ndarray, width: int) -> np.ndarray:
+    width = max(width, 1)
+    return np.convolve(profile, np.ones(width) / width, mode='same')
+
+def find_gutter(image: Image.Image) -> int | None:
+    # the x coordinate of the fold of a two page spread, None if the image
+    # doesn't look like one. text stops at the gutter, so the gutter is the
+    # column near the middle with the least ink across the whole height.
+    # the shadow of the fold is solid ink top to bottom and counts as none.
+    # it errs towards not splitting: a plate or table across the fold, or a
+    # spread with one empty side, stays a single page
+    width, height = image.size
+    if width < min_aspect * height:
+        return None
+    sample = image.convert('L')
+    sample.thumbnail((sample_size, sample_size))
+    gray = np.asarray(sample)
+    ink = gray <= otsu_threshold(gray)
+    columns = ink.mean(axis=0)
+    columns = np.where(columns > 0.6, 0.0, columns)
+    columns = smooth(columns, round(0.01 * len(columns)))
+    start, end = (round(fraction * len(columns)) for fraction in search_band)
+    lowest = start + int(np.argmin(columns[start:end]))
+    # the fold is in the middle of the run of empty columns between the pages
+    empty = np.flatnonzero(np.diff(np.concatenate(([1], columns[start:end] > columns[lowest] + 0.001, [1])).astype(np.int8)))
+    run_starts, run_ends = empty[::2] + start, empty[1::2] + start
+    run = np.flatnonzero((run_starts <= lowest) & (lowest < run_ends))[0]
+    gutter = int(run_starts[run] + run_ends[run]) // 2
+    left, right = columns[:gutter], columns[gutter:]
+    # both sides need text on them, far more than the gutter has
+    if not (left > 0.005).any() or not (right > 0.005).any():
+        return None
+    text = np.concatenate((left[left > 0.005], right[right > 0.005]))
+    if columns[gutter] > 0.1 * np.median(text):
+        return None
+    return round(gutter * width / len(columns))
+
+def split_spread(image: Image.Image, gutter: int) -> list[tuple[str, Image.Image]]:
+    # [(Page.Half, image), ...] in reading order
+    return [
+        (Page.Half.LEFT, image.crop((0, 0, gutter, image.height))),
+        (Page.Half.RIGHT, image.crop((gutter, 0, image.width, image.height))),
+    ]
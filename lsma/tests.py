@@ -1,3 +1,769 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image, ImageDraw, ImageFilter
+from pikepdf import Dictionary, Name, Pdf
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from uuid import NAMESPACE_URL, uuid4, uuid5
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+import numpy as np
+import requests
+
+from .classify import classify_page, get_page_stats
+from .download import download_url, download_urls
+from .loader import PageLoader
+from .models import Book, Box, Graphic, Page, Section
+from .ocr import BoxRecord, get_page_boxes, parse_tsv
+from .orientation import make_upright, to_original
+from .pdf import (add_book, add_metadata, get_fingerprint, get_page_hashes, iter_in_thread, move_page_references,
+                  renumber_pages, update_book)
+from .preprocess import Transform, preprocess
+from .spread import find_gutter
+
+
+class StandIn(BaseHTTPRequestHandler):
+    # a stand-in for the servers pdfs are downloaded from. what each path
+    # does is set on the server: data, ranges (whether Range is honoured),
+    # failures ({path: [status, ...]} answered before the data) and delay
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Range')))
+            host = self.headers['Host']
+            server.running[host] = server.running.get(host, 0) + 1
+            server.most_running[host] = max(server.most_running.get(host, 0), server.running[host])
+            failures = server.failures.get(self.path)
+            status = failures.pop(0) if failures else None
+        try:
+            time.sleep(server.delay)
+            if status:
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            data = server.data
+            requested = self.headers.get('Range')
+            if requested and server.ranges:
+                start = int(requested.removeprefix('bytes=').removesuffix('-'))
+                if start >= len(data):
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+                data = data[start:]
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with server.lock:
+                server.running[host] -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+        self.server.data = bytes(range(256)) * 100
+        self.server.ranges = True
+        self.server.failures = {}
+        self.server.delay = 0
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.running = {}
+        self.server.most_running = {}
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.port = self.server.server_address[1]
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        # retries don't wait. the module is swapped rather than time.sleep,
+        # which would stop the server's delay from working too
+        patcher = mock.patch('lsma.download.time')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def url(self, path='/book.pdf', host='127.0.0.1'):
+        return f'http://{host}:{self.port}{path}'
+
+    def path(self, name='book.pdf') -> Path:
+        return Path(self.folder.name) / name
+
+    def test_resumes_with_range(self):
+        Path(f'{self.path()}.part').write_bytes(self.server.data[:1000])
+        download_url(self.url(), self.path())
+        self.assertEqual(self.path().read_bytes(), self.server.data)
+        self.assertEqual(self.server.requests, [('/book.pdf', 'bytes=1000-')])
+        self.assertFalse(Path(f'{self.path()}.part').exists())
+
+    def test_starts_over_when_range_is_ignored(self):
+        self.server.ranges = False
+        Path(f'{self.path()}.part').write_bytes(b'not the start of the file')
+        download_url(self.url(), self.path())
+        self.assertEqual(self.path().read_bytes(), self.server.data)
+
+    def test_complete_part_file(self):
+        Path(f'{self.path()}.part').write_bytes(self.server.data)
+        download_url(self.url(), self.path())
+        self.assertEqual(self.path().read_bytes(), self.server.data)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retries_server_errors(self):
+        self.server.failures = {'/book.pdf': [503, 429, 500]}
+        download_url(self.url(), self.path(), retries=3)
+        self.assertEqual(self.path().read_bytes(), self.server.data)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = {'/book.pdf': [503] * 3}
+        with self.assertRaises(requests.HTTPError):
+            download_url(self.url(), self.path(), retries=2)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_no_retry_on_client_errors(self):
+        self.server.failures = {'/book.pdf': [404]}
+        with self.assertRaises(requests.HTTPError):
+            download_url(self.url(), self.path(), retries=3)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(self.path().exists())
+
+    def test_per_host_limit(self):
+        self.server.delay = 0.1
+        downloads = [(self.url(f'/{host}-{i}.pdf', host), self.path(f'{host}-{i}.pdf'))
+                     for host in ('127.0.0.1', 'localhost') for i in range(5)]
+        results = list(download_urls(downloads, workers=8, per_host=2))
+        self.assertEqual(sorted(url for url, _, error in results if error is None), sorted(url for url, _ in downloads))
+        for url, path in downloads:
+            self.assertEqual(path.read_bytes(), self.server.data)
+        self.assertEqual(set(self.server.most_running.values()), {2})
+
+    def test_per_host_has_to_be_positive(self):
+        with self.assertRaises(ValueError):
+            list(download_urls([(self.url(), self.path())], per_host=0))
+
+    def test_command_resumes_earlier_run(self):
+        # the .part a failed run of download_file left behind
+        os.chdir(self.folder.name)
+        self.addCleanup(os.chdir, os.getcwd())
+        Path('new_pdf_downloads').mkdir()
+        Path(f'new_pdf_downloads/{uuid5(NAMESPACE_URL, self.url())}.download.part').write_bytes(self.server.data[:1000])
+        command = 'lsma.management.commands.download_file'
+        with mock.patch(f'{command}.get_page_hashes'), \
+                mock.patch(f'{command}.find_duplicates', return_value=(None, None)):
+            call_command('download_file', self.url(), stdout=io.StringIO())
+        self.assertEqual(self.server.requests, [('/book.pdf', 'bytes=1000-')])
+        pdf_path, = Path('new_pdf_downloads').glob('*.pdf')
+        self.assertEqual(pdf_path.read_bytes(), self.server.data)
+        self.assertEqual(json.loads(Path(f'{pdf_path}.lsma.json').read_text())['uuid'], pdf_path.stem)
+        self.assertEqual(len(list(Path('new_pdf_downloads').iterdir())), 2)
+
+
+# two blocks, the first with two lines and the second with two paragraphs
+tsv = """level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext
+1\t1\t0\t0\t0\t0\t0\t0\t1000\t1400\t-1\t
+2\t1\t1\t0\t0\t0\t100\t100\t800\t80\t-1\t
+3\t1\t1\t1\t0\t0\t100\t100\t800\t80\t-1\t
+4\t1\t1\t1\t1\t0\t100\t100\t800\t30\t-1\t
+5\t1\t1\t1\t1\t1\t100\t100\t200\t30\t96.5\tThe
+5\t1\t1\t1\t1\t2\t320\t100\t200\t30\t91.0\tquick
+4\t1\t1\t1\t2\t0\t100\t150\t800\t30\t-1\t
+5\t1\t1\t1\t2\t1\t100\t150\t300\t30\t88.0\tbrown
+2\t1\t2\t0\t0\t0\t100\t300\t800\t100\t-1\t
+3\t1\t2\t1\t0\t0\t100\t300\t800\t30\t-1\t
+4\t1\t2\t1\t1\t0\t100\t300\t800\t30\t-1\t
+5\t1\t2\t1\t1\t1\t100\t300\t200\t30\t90.0\tfox
+3\t1\t2\t2\t0\t0\t100\t370\t800\t30\t-1\t
+4\t1\t2\t2\t1\t0\t100\t370\t800\t30\t-1\t
+5\t1\t2\t2\t1\t1\t100\t370\t200\t30\t85.0\tjumps
+"""
+
+
+class PageLoaderTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create()
+
+    def make_page(self, number):
+        # the dimensions are given so the image file is never opened
+        return Page(book=self.book, number=number, pdf_page_number=number,
+                    original_image=f'test/{number}.png', width=1000, height=1400)
+
+    def load(self, *pages_and_records, pages_per_copy=20):
+        loader = PageLoader(pages_per_copy=pages_per_copy)
+        for page, records in pages_and_records:
+            loader.add(page, records)
+        loader.flush()
+
+    def test_parents(self):
+        page = self.make_page(1)
+        self.load((page, parse_tsv(tsv)))
+        boxes = list(page.boxes.order_by('order'))
+        self.assertEqual(len(boxes), 15)
+        by_numbers = {(box.block_number, box.paragraph_number, box.line_number, box.word_number): box for box in boxes}
+        for box in boxes:
+            if box.level == Box.Level.PAGE:
+                self.assertIsNone(box.parent_id)
+                continue
+            numbers = [box.block_number, box.paragraph_number, box.line_number, box.word_number]
+            numbers[box.level - 2] = 0
+            parent = by_numbers[tuple(numbers)]
+            self.assertEqual(box.parent_id, parent.id, box)
+            self.assertEqual(parent.level, box.level - 1)
+        self.assertEqual([box.text for box in boxes if box.level == Box.Level.WORD], ['The', 'quick', 'brown', 'fox', 'jumps'])
+        self.assertEqual([box.original_confidence for box in boxes if box.level == Box.Level.WORD], [96.5, 91.0, 88.0, 90.0, 85.0])
+        self.assertIsNone(boxes[0].original_confidence)
+
+    def test_pages_in_one_copy(self):
+        # parents never point at a box of another page
+        pages = [self.make_page(number) for number in range(1, 4)]
+        self.load(*[(page, parse_tsv(tsv)) for page in pages], pages_per_copy=2)
+        for page in pages:
+            ids = set(page.boxes.values_list('id', flat=True))
+            parents = set(page.boxes.exclude(parent=None).values_list('parent_id', flat=True))
+            self.assertTrue(parents <= ids)
+
+    def test_escaping(self):
+        text = 'tab\there back\\slash new\nline cr\rend \\N'
+        records = [
+            BoxRecord(Box.Level.PAGE, 1, 0, 0, 0, 0, 0, 0, 100, 100, None, ''),
+            BoxRecord(Box.Level.BLOCK, 1, 1, 0, 0, 0, 0, 0, 100, 100, None, ''),
+            BoxRecord(Box.Level.PARAGRAPH, 1, 1, 1, 0, 0, 0, 0, 100, 100, None, ''),
+            BoxRecord(Box.Level.LINE, 1, 1, 1, 1, 0, 0, 0, 100, 100, None, ''),
+            BoxRecord(Box.Level.WORD, 1, 1, 1, 1, 1, 0, 0, 100, 100, 50.0, text),
+        ]
+        page = self.make_page(1)
+        self.load((page, records))
+        word = page.boxes.get(level=Box.Level.WORD)
+        self.assertEqual(word.text, text)
+        self.assertEqual(word.original_text, text)
+
+    def test_replaces_boxes_of_existing_pages(self):
+        page = self.make_page(1)
+        self.load((page, parse_tsv(tsv)))
+        page = Page.objects.get(pk=page.pk)
+        page.search_text = 'the quick'
+        self.load((page, parse_tsv(tsv)[:6]))
+        self.assertEqual(page.boxes.count(), 6)
+        self.assertEqual(Page.objects.get(pk=page.pk).search_text, 'the quick')
+
+
+def word(left, top, width, height, level=Box.Level.WORD):
+    return BoxRecord(level, 1, 1, 1, 1, 1, left, top, width, height, 90.0, 'word')
+
+def runs(mask: np.ndarray) -> list[tuple[int, int]]:
+    # (start, end) of each run of True
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+def ink_boxes(image: Image.Image) -> list[tuple[int, int, int, int]]:
+    # (left, top, right, bottom) of each blob of ink, row by row. the blobs
+    # have to sit in rows with clear space between them
+    ink = np.asarray(image.convert('L')) < 128
+    boxes = []
+    for top, bottom in runs(ink.any(axis=1)):
+        band = ink[top:bottom]
+        for left, right in runs(band.any(axis=0)):
+            rows = np.flatnonzero(band[:, left:right].any(axis=1))
+            boxes.append((left, top + int(rows[0]), right, top + int(rows[-1]) + 1))
+    return boxes
+
+
+class TransformTests(SimpleTestCase):
+    def test_crop_and_scale(self):
+        transform = Transform((1000, 800), offset=(100, 50), crop_size=(600, 500), scale=0.5)
+        self.assertEqual(transform.to_original(word(10, 20, 30, 40))[6:10], (120, 90, 60, 80))
+
+    def test_clamped_to_page(self):
+        transform = Transform((1000, 800), offset=(100, 50), crop_size=(900, 750), scale=2)
+        self.assertEqual(transform.to_original(word(1700, 1400, 200, 200))[6:10], (950, 750, 50, 50))
+
+    def test_page_box_is_whole_page(self):
+        transform = Transform((1000, 800), offset=(100, 50), crop_size=(600, 500), angle=1.5, scale=0.5)
+        record = transform.to_original(word(5, 5, 300, 250, level=Box.Level.PAGE))
+        self.assertEqual(record[6:10], (0, 0, 1000, 800))
+        self.assertEqual(record.level, Box.Level.PAGE)
+
+    def test_deskew(self):
+        # rows of small squares standing in for words, tilted by two degrees
+        # on a page with wide margins
+        upright = Image.new('L', (1200, 1000), 255)
+        draw = ImageDraw.Draw(upright)
+        for top in range(250, 750, 120):
+            for left in range(250, 950, 100):
+                draw.rectangle((left, top, left + 24, top + 24), fill=0)
+        original = upright.rotate(-2, resample=Image.BILINEAR, fillcolor=255)
+        config = {'x_height': None, 'binarize': True, 'deskew': True, 'crop': True, 'upscale': False}
+        result, transform = preprocess(original, config)
+        # turned back the way it was tilted
+        self.assertAlmostEqual(transform.angle, 2, delta=0.2)
+        self.assertNotEqual(transform.offset, (0, 0))
+        found = ink_boxes(result)
+        expected = ink_boxes(original)
+        self.assertEqual(len(found), 35)
+        self.assertEqual(len(expected), 35)
+        for (left, top, right, bottom), box in zip(found, expected):
+            mapped = transform.to_original(word(left, top, right - left, bottom - top))
+            mapped = (mapped.left, mapped.top, mapped.left + mapped.width, mapped.top + mapped.height)
+            for a, b in zip(mapped, box):
+                self.assertAlmostEqual(a, b, delta=3, msg=(mapped, box))
+
+
+class OrientationTests(SimpleTestCase):
+    # how a page is turned in the scan for each rotation of its text
+    scanned = {
+        None: None,
+        Page.Rotation.CLOCKWISE: Image.ROTATE_270,
+        Page.Rotation.COUNTERCLOCKWISE: Image.ROTATE_90,
+        Page.Rotation.UPSIDE_DOWN: Image.ROTATE_180,
+    }
+
+    def test_to_original(self):
+        upright = Image.new('L', (300, 200), 255)
+        ImageDraw.Draw(upright).rectangle((30, 40, 79, 59), fill=0)
+        record = word(30, 40, 50, 20)
+        for rotation, transpose in self.scanned.items():
+            with self.subTest(rotation=rotation):
+                scan = upright if transpose is None else upright.transpose(transpose)
+                self.assertEqual(list(make_upright(scan, rotation).getdata()), list(upright.getdata()))
+                mapped = to_original(record, rotation, scan.size)
+                self.assertEqual(ink_boxes(scan), [(mapped.left, mapped.top, mapped.left + mapped.width, mapped.top + mapped.height)])
+                self.assertEqual(mapped.text, record.text)
+
+    @override_settings(DETECT_ROTATION=True)
+    def test_osd_gives_up(self):
+        # a sparse page looks sideways but osd can't tell. every way reads
+        # as well as the others, so it stays upright
+        image = Image.new('L', (300, 200), 255)
+        tried = []
+
+        def get_boxes(image, use_cache, preprocess_config):
+            tried.append(image.size)
+            return [word(10, 10, 20, 20)]
+
+        with mock.patch('lsma.ocr.engine') as engine, \
+                mock.patch('lsma.ocr.looks_sideways', return_value=True), \
+                mock.patch('lsma.ocr.get_boxes', side_effect=get_boxes):
+            engine.osd.return_value = None
+            records, rotation = get_page_boxes(image)
+        self.assertIsNone(rotation)
+        self.assertEqual(tried, [(300, 200), (200, 300), (200, 300)])
+        self.assertEqual(records, [word(10, 10, 20, 20)])
+
+
+def draw_text(draw, left, right, top=100, bottom=1100):
+    # lines of word sized blocks between left and right, the spaces between
+    # words move from line to line like they do in real text
+    for line, line_top in enumerate(range(top, bottom, 40)):
+        for word_left in range(left + line * 23 % 50, right - 60, 75):
+            draw.rectangle((word_left, line_top, word_left + 60, line_top + 16), fill=30)
+
+
+class GutterTests(SimpleTestCase):
+    def spread(self, gutter=900, shadow=False) -> Image.Image:
+        image = Image.new('L', (1800, 1200), 235)
+        draw = ImageDraw.Draw(image)
+        draw_text(draw, 120, gutter - 100)
+        draw_text(draw, gutter + 100, 1680)
+        if shadow:
+            draw.rectangle((gutter - 12, 0, gutter + 12, 1200), fill=60)
+        return image
+
+    def test_spread(self):
+        for gutter in (900, 840, 990):
+            for shadow in (False, True):
+                with self.subTest(gutter=gutter, shadow=shadow):
+                    found = find_gutter(self.spread(gutter, shadow))
+                    self.assertIsNotNone(found)
+                    self.assertAlmostEqual(found, gutter, delta=20)
+
+    def test_portrait(self):
+        image = Image.new('L', (900, 1200), 235)
+        draw_text(ImageDraw.Draw(image), 120, 780)
+        self.assertIsNone(find_gutter(image))
+
+    def test_text_across(self):
+        image = Image.new('L', (1800, 1200), 235)
+        draw_text(ImageDraw.Draw(image), 120, 1680)
+        self.assertIsNone(find_gutter(image))
+
+    def test_one_side_empty(self):
+        image = Image.new('L', (1800, 1200), 235)
+        draw_text(ImageDraw.Draw(image), 1000, 1680)
+        self.assertIsNone(find_gutter(image))
+
+    def test_plate_across_fold(self):
+        image = self.spread()
+        ImageDraw.Draw(image).rectangle((500, 300, 1300, 800), fill=90)
+        self.assertIsNone(find_gutter(image))
+
+
+class RenumberTests(TestCase):
+    def add_pages(self, book, *pages):
+        for pdf_page_number, half in pages:
+            Page.objects.create(book=book, number=None, pdf_page_number=pdf_page_number, spread_half=half,
+                                original_image=f'{book.pk}/{pdf_page_number}{half or ""}.png', width=100, height=100)
+
+    def numbers(self, book):
+        return list(book.pages.order_by('pdf_page_number', 'spread_half').values_list('pdf_page_number', 'spread_half', 'number'))
+
+    def test_spreads(self):
+        book = Book.objects.create()
+        left, right = Page.Half.LEFT, Page.Half.RIGHT
+        self.add_pages(book, (6, None), (5, right), (5, left), (4, None), (3, left), (3, right), (2, None))
+        renumber_pages(book)
+        self.assertEqual(self.numbers(book), [
+            (2, None, 2), (3, left, 3), (3, right, 4), (4, None, 5), (5, left, 6), (5, right, 7), (6, None, 8),
+        ])
+
+    def test_no_spreads(self):
+        book = Book.objects.create()
+        other = Book.objects.create()
+        self.add_pages(book, (1, None), (2, None), (3, None))
+        self.add_pages(other, (1, Page.Half.LEFT), (1, Page.Half.RIGHT))
+        renumber_pages(book)
+        self.assertEqual(self.numbers(book), [(1, None, 1), (2, None, 2), (3, None, 3)])
+        # other books are left alone
+        self.assertEqual(list(other.pages.values_list('number', flat=True)), [None, None])
+
+
+class IterInThreadTests(SimpleTestCase):
+    def consume(self, consumer):
+        # consumer runs in a thread of its own so a hang fails the test
+        # instead of the test run
+        thread = threading.Thread(target=consumer, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'iter_in_thread hung')
+
+    def test_all_items(self):
+        result = []
+        self.consume(lambda: result.extend(iter_in_thread(range(100), 2)))
+        self.assertEqual(result, list(range(100)))
+
+    def test_consumer_stops_early(self):
+        # the producer is blocked on a full queue when the consumer stops
+        produced = []
+
+        def items():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        def consumer():
+            items_in_thread = iter_in_thread(items(), 1)
+            self.assertEqual([next(items_in_thread), next(items_in_thread)], [0, 1])
+            time.sleep(0.2)
+            items_in_thread.close()
+
+        self.consume(consumer)
+        self.assertLess(len(produced), 10)
+
+    def test_consumer_stops_at_the_end(self):
+        # the producer has run out of items and is waiting to say so
+        def consumer():
+            items_in_thread = iter_in_thread(range(2), 1)
+            self.assertEqual(next(items_in_thread), 0)
+            time.sleep(0.2)
+            items_in_thread.close()
+
+        self.consume(consumer)
+
+    def test_error(self):
+        def items():
+            yield 1
+            raise KeyError('broken page')
+
+        def consumer():
+            with self.assertRaises(KeyError):
+                list(iter_in_thread(items(), 1))
+
+        self.consume(consumer)
+
+
+def make_scan_pdf(path, shades, unused_font=False):
+    # a page per shade, each a scan drawn through a form the way some
+    # scanning software does it
+    pdf = Pdf.new()
+    for shade in shades:
+        image = pdf.make_stream(bytes([shade]) * 256, Type=Name.XObject, Subtype=Name.Image, Width=16, Height=16,
+                                ColorSpace=Name.DeviceGray, BitsPerComponent=8)
+        form = pdf.make_stream(b'q 612 0 0 792 0 0 cm /Im0 Do Q', Type=Name.XObject, Subtype=Name.Form,
+                               BBox=[0, 0, 612, 792], Resources=Dictionary(XObject=Dictionary(Im0=image)))
+        page = pdf.add_blank_page(page_size=(612, 792))
+        page.obj.Resources = Dictionary(XObject=Dictionary(Fm0=form))
+        if unused_font:
+            page.obj.Resources.Font = Dictionary(F9=pdf.make_indirect(Dictionary(
+                Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Courier)))
+        page.obj.Contents = pdf.make_stream(b'/Fm0 Do')
+    pdf.save(path)
+
+def make_text_pdf(path, font):
+    pdf = Pdf.new()
+    page = pdf.add_blank_page(page_size=(612, 792))
+    page.obj.Resources = Dictionary(Font=Dictionary(F1=pdf.make_indirect(Dictionary(
+        Type=Name.Font, Subtype=Name.Type1, BaseFont=Name(f'/{font}')))))
+    page.obj.Contents = pdf.make_stream(b'BT /F1 12 Tf 72 700 Td (Hello) Tj ET')
+    pdf.save(path)
+
+
+class PageHashTests(SimpleTestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def path(self, name) -> Path:
+        return Path(self.folder.name) / name
+
+    def test_scans_in_forms(self):
+        make_scan_pdf(self.path('a.pdf'), [10, 20, 30])
+        make_scan_pdf(self.path('b.pdf'), [40, 50, 60])
+        a, b = get_page_hashes(self.path('a.pdf')), get_page_hashes(self.path('b.pdf'))
+        self.assertEqual(len(set(a.values()) | set(b.values())), 6)
+        self.assertNotEqual(get_fingerprint(a), get_fingerprint(b))
+
+    def test_same_drawing(self):
+        # resources that aren't drawn and where objects end up in the file
+        # make no difference
+        make_scan_pdf(self.path('a.pdf'), [10, 20, 30])
+        make_scan_pdf(self.path('b.pdf'), [10, 20, 30], unused_font=True)
+        with Pdf.open(self.path('a.pdf')) as pdf:
+            pdf.pages.reverse()
+            pdf.save(self.path('reversed.pdf'))
+        a = get_page_hashes(self.path('a.pdf'))
+        self.assertEqual(get_page_hashes(self.path('b.pdf')), a)
+        self.assertEqual(get_page_hashes(self.path('reversed.pdf')), {1: a[3], 2: a[2], 3: a[1]})
+
+    def test_fonts(self):
+        make_text_pdf(self.path('a.pdf'), 'Helvetica')
+        make_text_pdf(self.path('b.pdf'), 'Times-Roman')
+        self.assertNotEqual(get_page_hashes(self.path('a.pdf')), get_page_hashes(self.path('b.pdf')))
+
+
+def make_paper(shade=232, noise=3.0, size=(1700, 2200)) -> Image.Image:
+    rng = np.random.default_rng(0)
+    pixels = shade + rng.normal(0, noise, (size[1], size[0]))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+def draw_letters(image, ink, stroke=3, top=200, bottom=2000, left=200, right=1500):
+    # lines of body text at about 200 dpi, letters made of stems, bowls and arches
+    rng = np.random.default_rng(1)
+    draw = ImageDraw.Draw(image)
+    for line_top in range(top, bottom, 60):
+        x = left + int(rng.integers(0, 40))
+        while x < right - 40:
+            for shape in rng.integers(0, 3, int(rng.integers(2, 9))):
+                if shape == 0:
+                    draw.line((x + 2, line_top, x + 2, line_top + 30), fill=ink, width=stroke)
+                elif shape == 1:
+                    draw.ellipse((x, line_top + 12, x + 16, line_top + 30), outline=ink, width=stroke)
+                else:
+                    draw.line((x + 2, line_top + 12, x + 2, line_top + 30), fill=ink, width=stroke)
+                    draw.arc((x, line_top + 12, x + 16, line_top + 24), 180, 360, fill=ink, width=stroke)
+                x += 20
+            x += 18
+    return image
+
+
+class ClassifyTests(SimpleTestCase):
+    def test_blank(self):
+        self.assertEqual(classify_page(make_paper()), Page.Kind.BLANK)
+        self.assertEqual(classify_page(make_paper(255, 0)), Page.Kind.BLANK)
+
+    def test_dust(self):
+        image = make_paper()
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((400, 700, 412, 712), fill=60)
+        draw.ellipse((1200, 1600, 1210, 1609), fill=80)
+        self.assertEqual(classify_page(image), Page.Kind.BLANK)
+
+    def test_bleed_through(self):
+        # the text on the other side of the leaf shows through as a shadow
+        back = draw_letters(Image.new('L', (1700, 2200), 255), 0, stroke=4)
+        back = back.transpose(Image.FLIP_LEFT_RIGHT).filter(ImageFilter.GaussianBlur(3))
+        shadow = (255 - np.asarray(back, dtype=np.float64)) / 255 * 18
+        image = Image.fromarray(np.clip(np.asarray(make_paper(), dtype=np.float64) - shadow, 0, 255).astype(np.uint8))
+        self.assertEqual(classify_page(image), Page.Kind.BLANK)
+
+    def test_text(self):
+        self.assertIsNone(classify_page(draw_letters(make_paper(), 30)))
+
+    def test_faint_text(self):
+        image = draw_letters(make_paper(230), 160)
+        self.assertLess(get_page_stats(image)['contrast'], 40)
+        self.assertIsNone(classify_page(image))
+        self.assertIsNone(classify_page(draw_letters(make_paper(230), 180, stroke=2)))
+
+    def test_faint_caption(self):
+        image = draw_letters(make_paper(230), 180, stroke=2, top=1000, bottom=1050, left=700, right=1000)
+        self.assertIsNone(classify_page(image))
+
+    def test_endpaper(self):
+        # marbling, swirls of two shades from edge to edge
+        width, height = 1700, 2200
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                swirl = np.random.default_rng(seed).normal(0, 1, (40, 32)).astype(np.float32)
+                swirl = np.asarray(Image.fromarray(swirl, 'F').resize((width, height), Image.BICUBIC))
+                ys, xs = np.mgrid[0:height, 0:width]
+                pixels = 150 + 60 * (np.sin(xs / 25 + swirl * 6) + 0.5 * np.sin(ys / 40 - swirl * 4))
+                image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).convert('RGB')
+                self.assertEqual(classify_page(image), Page.Kind.DECORATIVE_PAPER)
+
+
+@override_settings(METRICS_FILE='', METRICS_PROMETHEUS_FILE='', OCR_CACHE_DIR='', VECTOR_TEXT=True,
+                   SPLIT_SPREADS=False, SKIP_BLANK_PAGES=False)
+class UpdateBookTests(TestCase):
+    # born digital pages, their words come from the text layer and tesseract
+    # is never run
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder.name)
+        Path('original_page_images').mkdir()
+        # the storage keeps the folder it first saw, so point it at this one
+        media = override_settings(MEDIA_ROOT=folder.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        for patcher in (mock.patch('lsma.ocr.pytesseract.get_tesseract_version', return_value='5.3.0'),
+                        mock.patch('lsma.pdf.ocr_pool', lambda workers: ThreadPoolExecutor(workers))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pdf_path = Path('book.pdf')
+        self.uuid = uuid4()
+
+    def write_pdf(self, subjects):
+        pdf = Pdf.new()
+        for subject in subjects:
+            page = pdf.add_blank_page(page_size=(300, 400))
+            page.obj.Resources = Dictionary(Font=Dictionary(F1=pdf.make_indirect(Dictionary(
+                Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Helvetica))))
+            page.obj.Contents = pdf.make_stream(f'BT /F1 14 Tf 20 350 Td (this page of the book is all about {subject}) Tj ET'.encode())
+        pdf.save(self.pdf_path)
+        add_metadata(self.pdf_path, 'https://example.com/book.pdf', self.uuid)
+
+    def import_book(self, subjects):
+        self.write_pdf(subjects)
+        add_book(self.pdf_path)
+        book = Book.objects.get(uuid=self.uuid)
+        # a correction somebody made by hand
+        self.fixed = book.pages.get(pdf_page_number=4).boxes.get(level=Box.Level.WORD, text=subjects[3])
+        self.fixed.text = subjects[3].upper()
+        self.fixed.save()
+        return book, {subject: page for subject, page in zip(subjects, book.pages.order_by('pdf_page_number'))}
+
+    def images(self, pages) -> dict:
+        return {page.pk: Path(page.original_image.name).read_bytes() for page in pages}
+
+    def assert_pages(self, book, subjects, pages, images):
+        # subjects are in their new order, None for a page new to the db
+        now = list(book.pages.order_by('pdf_page_number'))
+        self.assertEqual(len(now), len(subjects))
+        for number, (page, subject) in enumerate(zip(now, subjects), start=1):
+            self.assertEqual((page.pdf_page_number, page.number), (number, number))
+            self.assertEqual(Path(page.original_image.name).name, f'{number}.png')
+            if subject is None:
+                self.assertNotIn(page.pk, images)
+            else:
+                self.assertEqual(page.pk, pages[subject].pk)
+                self.assertEqual(Path(page.original_image.name).read_bytes(), images[page.pk])
+        self.fixed.refresh_from_db()
+        self.assertEqual(self.fixed.text, self.fixed.original_text.upper())
+
+    def test_insert(self):
+        subjects = ['apples', 'pears', 'plums', 'figs', 'dates']
+        book, pages = self.import_book(subjects)
+        images = self.images(pages.values())
+        self.write_pdf(['cover'] + subjects)
+        update_book(self.pdf_path)
+        self.assert_pages(book, [None] + subjects, pages, images)
+        self.assertIn('cover', book.pages.get(pdf_page_number=1).search_text)
+
+    def test_remove(self):
+        subjects = ['apples', 'pears', 'plums', 'figs', 'dates']
+        book, pages = self.import_book(subjects)
+        images = self.images(pages.values())
+        # a page that something refers to stays, out of the way
+        Section.objects.create(book=book, heading_page=pages['plums'], kind=Section.Kind.CHAPTER)
+        self.write_pdf(['apples', 'figs', 'dates'])
+        update_book(self.pdf_path)
+        self.assertFalse(Page.objects.filter(pk=pages['pears'].pk).exists())
+        plums = Page.objects.get(pk=pages['plums'].pk)
+        self.assertEqual(Path(plums.original_image.name).name, f'removed-{plums.pk}-3.png')
+        self.assertEqual(Path(plums.original_image.name).read_bytes(), images[plums.pk])
+        kept = book.pages.exclude(pk=plums.pk)
+        self.assertEqual(list(kept.order_by('pdf_page_number').values_list('pk', flat=True)),
+                         [pages[subject].pk for subject in ('apples', 'figs', 'dates')])
+        for number, page in enumerate(kept.order_by('pdf_page_number'), start=1):
+            self.assertEqual(Path(page.original_image.name).name, f'{number}.png')
+            self.assertEqual(Path(page.original_image.name).read_bytes(), images[page.pk])
+        self.fixed.refresh_from_db()
+        self.assertEqual(self.fixed.text, 'FIGS')
+
+    def test_failed_update_puts_images_back(self):
+        subjects = ['apples', 'pears', 'plums', 'figs', 'dates']
+        book, pages = self.import_book(subjects)
+        images = self.images(pages.values())
+        self.write_pdf(['cover'] + subjects)
+        with mock.patch('lsma.pdf.add_pages', side_effect=RuntimeError('ocr died')):
+            with self.assertRaises(RuntimeError):
+                update_book(self.pdf_path)
+        self.assert_pages(book, subjects, pages, images)
+        self.assertEqual(sorted(path.name for path in Path(pages['apples'].original_image.name).parent.iterdir()),
+                         [f'{number}.png' for number in range(1, 6)])
+
+
+class MovePageReferencesTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create()
+
+    def add_page(self, half, width):
+        return Page.objects.create(book=self.book, pdf_page_number=3, spread_half=half,
+                                   original_image=f'{self.book.pk}/3{half or ""}.png', width=width, height=1000)
+
+    def test_spread_to_whole(self):
+        left, right = self.add_page(Page.Half.LEFT, 500), self.add_page(Page.Half.RIGHT, 600)
+        whole = self.add_page(None, 1100)
+        section = Section.objects.create(book=self.book, heading_page=left, kind=Section.Kind.CHAPTER)
+        section.pages.add(left, right)
+        self.book.title_page = right
+        self.book.save()
+        plate = Graphic.objects.create(page=right, left=100, left_with_text=80, width=200)
+        move_page_references(left, [whole])
+        move_page_references(right, [whole])
+        section.refresh_from_db()
+        self.assertEqual(section.heading_page, whole)
+        # the halves go from the section along with their rows
+        self.assertEqual(set(section.pages.all()), {left, right, whole})
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.title_page, whole)
+        plate.refresh_from_db()
+        self.assertEqual((plate.page, plate.left, plate.left_with_text), (whole, 600, 580))
+
+    def test_whole_to_spread(self):
+        whole = self.add_page(None, 1100)
+        left, right = self.add_page(Page.Half.LEFT, 500), self.add_page(Page.Half.RIGHT, 600)
+        section = Section.objects.create(book=self.book, heading_page=whole, kind=Section.Kind.CHAPTER)
+        section.pages.add(whole)
+        plates = [Graphic.objects.create(page=whole, left=x, left_with_text=x - 20) for x in (100, 700)]
+        move_page_references(whole, [left, right])
+        section.refresh_from_db()
+        self.assertEqual(section.heading_page, left)
+        self.assertEqual(set(section.pages.all()), {whole, left, right})
+        for plate in plates:
+            plate.refresh_from_db()
+        self.assertEqual([(plate.page, plate.left, plate.left_with_text) for plate in plates],
+                         [(left, 100, 80), (right, 200, 180)])
@@ -0,0 +1,135 @@
+from PIL import Image
+from statistics import median
+import ctypes
+
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+except ImportError:
+    pdfium = None
+
+from .models import Box
+from .ocr import BoxRecord
+
+# dpi pages without a scanned image are rendered at
+render_dpi = 300
+# fewer characters than this and a page is treated as having no text layer
+min_chars = 20
+# starts the ocr_version of pages whose boxes came from the text layer
+text_layer_prefix = 'pdfium-'
+
+
+def text_layer_version() -> str | None:
+    return f'{text_layer_prefix}{pdfium.PDFIUM_INFO}' if pdfium else None
+
+def open_document(pdf_path):
+    return pdfium.PdfDocument(str(pdf_path)) if pdfium else None
+
+def render_page(document, number, dpi=render_dpi) -> Image.Image:
+    return document[number - 1].render(scale=dpi / 72).to_pil()
+
+def get_lines(textpage) -> list[list[tuple[str, tuple]]]:
+    # [[(word, (left, bottom, right, top)), ...], ...] in pdf units. pdfium
+    # adds the line breaks and spaces between words itself, with empty boxes
+    lines = []
+    line = []
+    word = ''
+    word_box = None
+
+    def end_word():
+        nonlocal word, word_box
+        if word:
+            line.append((word, word_box))
+        word, word_box = '', None
+
+    def end_line():
+        nonlocal line
+        end_word()
+        if line:
+            lines.append(line)
+        line = []
+
+    for i in range(textpage.count_chars()):
+        char = textpage.get_text_range(i, 1)
+        if char in ('\r', '\n'):
+            end_line()
+            continue
+        if not char or char.isspace():
+            end_word()
+            continue
+        left, bottom, right, top = textpage.get_charbox(i)
+        if word_box is None:
+            word_box = (left, bottom, right, top)
+        else:
+            word_box = (min(word_box[0], left), min(word_box[1], bottom), max(word_box[2], right), max(word_box[3], top))
+        word += char
+    end_line()
+    return lines
+
+def has_text_layer(lines) -> bool:
+    chars = ''.join(word for line in lines for word, _ in line)
+    unmapped = sum(1 for char in chars if char == '�' or not char.isprintable())
+    return len(chars) >= min_chars and unmapped < 0.05 * len(chars)
+
+def get_page_to_pixels(page, image_size, rendered=True):
+    # maps a (left, bottom, right, top) box in pdf units to (left, top,
+    # width, height) in the pixels of the page image, through the page's
+    # crop box origin and rotation the way pdfium renders it. a scanned
+    # image is stored as it is in the pdf, unturned by /Rotate. boxes that
+    # stick out past the page are cut off at its edge
+    width, height = image_size
+    # pdfium adds its rotate argument (in quarter turns) to the page's own
+    rotate = 0 if rendered else (-page.get_rotation() // 90) % 4
+    x, y = ctypes.c_int(), ctypes.c_int()
+
+    def to_device(page_x, page_y):
+        pdfium_c.FPDF_PageToDevice(page.raw, 0, 0, width, height, rotate, page_x, page_y, ctypes.byref(x), ctypes.byref(y))
+        return min(max(x.value, 0), width), min(max(y.value, 0), height)
+
+    def to_pixels(box):
+        left, bottom, right, top = box
+        corners = [to_device(left, bottom), to_device(right, top)]
+        xs, ys = [x for x, _ in corners], [y for _, y in corners]
+        return min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)
+
+    return to_pixels
+
+def get_text_records(document, number, image_size, rendered=True) -> list[BoxRecord] | None:
+    # the page's words as box records in the same page, block, paragraph,
+    # line, word order tesseract gives them, in the pixel coordinates of the
+    # page image. None if the page has no usable text layer
+    page = document[number - 1]
+    textpage = page.get_textpage()
+    try:
+        lines = get_lines(textpage)
+    finally:
+        textpage.close()
+    if not has_text_layer(lines):
+        return None
+    to_pixels = get_page_to_pixels(page, image_size, rendered)
+
+    def union(boxes):
+        return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+    # a gap between lines bigger than most line heights starts a new block
+    line_boxes = [union([box for _, box in line]) for line in lines]
+    line_height = median(box[3] - box[1] for box in line_boxes)
+    blocks = []
+    for line, box in zip(lines, line_boxes):
+        if not blocks or blocks[-1][-1][1][1] - box[3] > 0.8 * line_height:
+            blocks.append([])
+        blocks[-1].append((line, box))
+
+    records = [BoxRecord(Box.Level.PAGE, 1, 0, 0, 0, 0, 0, 0, *image_size, None, '')]
+    for block_number, block in enumerate(blocks, start=1):
+        block_box = to_pixels(union([box for _, box in block]))
+        # pdfs don't mark paragraphs, each block is one
+        records.append(BoxRecord(Box.Level.BLOCK, 1, block_number, 0, 0, 0, *block_box, None, ''))
+        records.append(BoxRecord(Box.Level.PARAGRAPH, 1, block_number, 1, 0, 0, *block_box, None, ''))
+        for line_number, (line, box) in enumerate(block, start=1):
+            records.append(BoxRecord(Box.Level.LINE, 1, block_number, 1, line_number, 0, *to_pixels(box), None, ''))
+            for word_number, (word, word_box) in enumerate(line, start=1):
+                # the pdf says nothing about how sure whoever made it was
+                records.append(BoxRecord(Box.Level.WORD, 1, block_number, 1, line_number, word_number, *to_pixels(word_box), None, word))
+    return records
@@ -136,3 +136,43 @@ STATICFILES_DIRS = (os.path.join(BASE_DIR, 'static/'),
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# tesseract output cache, set OCR_CACHE_DIR to an empty string to turn it off
+OCR_CACHE_DIR = env('OCR_CACHE_DIR', default=os.path.join(BASE_DIR, 'ocr_cache/'))
+OCR_CACHE_MAX_BYTES = env.int('OCR_CACHE_MAX_BYTES', default=20 * 1024**3)
+
+# per page and per book import timings as json lines, empty to turn it off
+METRICS_FILE = env('METRICS_FILE', default=os.path.join(BASE_DIR, 'ingest_metrics.jsonl'))
+# running totals for node_exporter's textfile collector, off unless set
+METRICS_PROMETHEUS_FILE = env('METRICS_PROMETHEUS_FILE', default='')
+
+# take the words of pages that have a text layer from the pdf instead of running tesseract
+VECTOR_TEXT = env.bool('VECTOR_TEXT', default=True)
+# scans often carry an invisible ocr layer from whoever made the pdf. it is
+# only used instead of tesseract if this is set
+VECTOR_TEXT_ON_SCANS = env.bool('VECTOR_TEXT_ON_SCANS', default=False)
+
+# what is done to page images before tesseract sees them. text is scaled
+# down until its x-height is OCR_X_HEIGHT pixels, 0 leaves the size alone
+OCR_PREPROCESS = env.bool('OCR_PREPROCESS', default=True)
+OCR_X_HEIGHT = env.int('OCR_X_HEIGHT', default=20)
+OCR_BINARIZE = env.bool('OCR_BINARIZE', default=True)
+OCR_DESKEW = env.bool('OCR_DESKEW', default=True)
+OCR_CROP_MARGINS = env.bool('OCR_CROP_MARGINS', default=True)
+
+# tessdata directory with better (slower) models for reocr_low_confidence, e.g.
+# a checkout of tessdata_best. the default models are used when empty
+REOCR_TESSDATA_DIR = env('REOCR_TESSDATA_DIR', default='')
+
+# don't run tesseract on pages that look blank or like decorative paper
+SKIP_BLANK_PAGES = env.bool('SKIP_BLANK_PAGES', default=True)
+
+# check for sideways pages and turn them upright before ocr
+DETECT_ROTATION = env.bool('DETECT_ROTATION', default=True)
+
+# split scans of two page spreads into a page for each side before ocr
+SPLIT_SPREADS = env.bool('SPLIT_SPREADS', default=True)
+
+# rebuild a page's text as soon as edits to its words commit, instead of
+# leaving it for manage.py flush_page_text
+PAGE_TEXT_AFTER_COMMIT = env.bool('PAGE_TEXT_AFTER_COMMIT', default=False)